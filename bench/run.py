@@ -0,0 +1,263 @@
+"""
+Benchmark / load test ל-CodeBot MCP Server.
+─────────────────────────────────────────────
+מריץ את mcp.streamable_http_app() האמיתי על פורט מקומי, מול mongod מקומי
+(MONGO_URI) או mongomock בתוך התהליך, ומול stubs של Render ו-GitHub.
+כל כלי מופעל ע"י לקוחות MCP מקבילים דרך HTTP, והתוצאה היא p50/p95/p99 ו-req/s
+לכל כלי, עם השוואה ל-baseline שמור.
+
+דוגמאות:
+    python bench/run.py --mongomock --snippets 10000
+    MONGO_URI=mongodb://localhost:27017 python bench/run.py --snippets 1000000 --concurrency 32
+    python bench/run.py --mongomock --save-baseline bench/baseline.json
+    python bench/run.py --mongomock --baseline bench/baseline.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = (
+    "retry backoff cache parse json http client async await queue worker token auth "
+    "mongo index query sort filter map reduce stream buffer socket timeout logger config "
+    "render deploy github issue snippet vector search regex thread lock pool batch"
+).split()
+LANGUAGES = ["python", "javascript", "typescript", "go", "bash", "sql"]
+
+
+def _port_free() -> int:
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve_in_thread(app, port: int):
+    """הרצת אפליקציית ASGI ב-uvicorn על thread נפרד, והמתנה עד שהיא מאזינה."""
+    import uvicorn
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def _fake_snippet(rng: random.Random, i: int) -> dict:
+    words = rng.sample(WORDS, 6)
+    body_lines = [
+        f"def {words[0]}_{words[1]}_{i}({words[2]}, {words[3]}):",
+        f"    for attempt in range({rng.randint(2, 8)}):",
+        f"        result = {words[4]}.{words[5]}({words[2]})",
+        "        if result:",
+        "            return result",
+    ]
+    body_lines += [f"    # {' '.join(rng.sample(WORDS, 5))}" for _ in range(rng.randint(2, 40))]
+    created = datetime.now(timezone.utc) - timedelta(minutes=i)
+    return {
+        "title": f"{words[0]} {words[1]} helper {i}",
+        "code": "\n".join(body_lines),
+        "language": rng.choice(LANGUAGES),
+        "description": " ".join(rng.sample(WORDS, 8)),
+        "tags": rng.sample(WORDS, 3),
+        "created_at": created,
+        "updated_at": created,
+        "source": "bench",
+    }
+
+
+def seed(col, count: int, seed_value: int = 42, batch: int = 5000):
+    """זריעת dataset דטרמיניסטי. מדלג אם האוסף כבר מכיל לפחות count מסמכים מה-benchmark."""
+    existing = col.count_documents({"source": "bench"})
+    if existing >= count:
+        print(f"· dataset קיים: {existing} snippets")
+        return
+    rng = random.Random(seed_value)
+    for _ in range(existing):
+        _fake_snippet(rng, 0)
+    started = time.perf_counter()
+    for start in range(existing, count, batch):
+        col.insert_many([_fake_snippet(rng, i) for i in range(start, min(start + batch, count))], ordered=False)
+    print(f"· נזרעו {count - existing} snippets ב-{time.perf_counter() - started:.1f}s")
+
+
+def scenario(sample_ids: list[str]) -> dict:
+    """כלי → פונקציה שמייצרת ארגומנטים לכל קריאה."""
+    pick = random.choice
+    return {
+        "list_snippets": lambda: {"limit": 20, "language": pick(LANGUAGES)},
+        "list_snippets_search": lambda: {"limit": 20, "search": pick(WORDS)},
+        "get_snippet": lambda: {"snippet_id": pick(sample_ids)},
+        "search_by_code": lambda: {"pattern": f"{pick(WORDS)}\\.{pick(WORDS)}"},
+        "search_by_code_context": lambda: {"pattern": pick(WORDS), "context_lines": 2},
+        "semantic_search": lambda: {"query": " ".join(random.sample(WORDS, 3))},
+        "get_stats": lambda: {},
+        "analyze_snippet": lambda: {"snippet_id": pick(sample_ids)},
+        "create_snippet": lambda: {"title": "bench create", "code": "print('bench')", "tags": ["bench-write"]},
+        "bulk_tag_snippets_dry_run": lambda: {"search": pick(WORDS), "add_tags": ["bench"], "dry_run": True},
+        "render_service_status": lambda: {},
+        "render_get_logs": lambda: {"limit": 100},
+        "github_list_issues": lambda: {"limit": 30},
+    }
+
+
+def _tool_name(key: str) -> str:
+    for suffix in ("_search", "_context", "_dry_run"):
+        if key.endswith(suffix) and key != "semantic_search":
+            return key[: -len(suffix)]
+    return key
+
+
+async def run_tool(base_url: str, key: str, make_args, requests: int, concurrency: int) -> dict:
+    import httpx
+
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(requests))
+    headers = {"Accept": "application/json, text/event-stream"}
+
+    async def client_loop(client):
+        nonlocal errors
+        for n in counter:
+            payload = {"jsonrpc": "2.0", "id": n, "method": "tools/call",
+                       "params": {"name": _tool_name(key), "arguments": make_args()}}
+            started = time.perf_counter()
+            try:
+                resp = await client.post(f"{base_url}/mcp", json=payload, headers=headers)
+                body = resp.json()
+                failed = resp.status_code != 200 or "error" in body or body.get("result", {}).get("isError")
+            except Exception:
+                failed = True
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += bool(failed)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    q = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(q[49], 2),
+        "p95_ms": round(q[94], 2),
+        "p99_ms": round(q[98], 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """השוואה ל-baseline: p95 איטי יותר או req/s נמוך יותר ביותר מ-tolerance נחשב רגרסיה."""
+    regressions = []
+    for key, cur in results.items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {base['p95_ms']}ms → {cur['p95_ms']}ms")
+        if cur["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: req/s {base['rps']} → {cur['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CodeBot MCP benchmark")
+    parser.add_argument("--snippets", type=int, default=10000, help="גודל ה-dataset (ברירת מחדל: 10000)")
+    parser.add_argument("--requests", type=int, default=200, help="קריאות לכל כלי")
+    parser.add_argument("--concurrency", type=int, default=8, help="לקוחות MCP מקבילים")
+    parser.add_argument("--tools", default="", help="רשימת כלים מופרדת בפסיקים (ברירת מחדל: כולם)")
+    parser.add_argument("--mongomock", action="store_true", help="mongomock בתוך התהליך במקום MONGO_URI")
+    parser.add_argument("--upstream-latency", type=float, default=80, help="השהיית ה-stubs במילישניות")
+    parser.add_argument("--upstream-429", type=float, default=0.0, help="שיעור תשובות 429 מה-stubs (0-1)")
+    parser.add_argument("--baseline", help="קובץ baseline להשוואה")
+    parser.add_argument("--save-baseline", help="שמירת התוצאות כ-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="סטייה מותרת מה-baseline (ברירת מחדל: 0.2)")
+    args = parser.parse_args()
+
+    from bench.stubs import github_stub, render_stub
+
+    render_port, github_port, server_port = _port_free(), _port_free(), _port_free()
+    _serve_in_thread(render_stub(args.upstream_latency, rate_limit_ratio=args.upstream_429), render_port)
+    _serve_in_thread(github_stub(args.upstream_latency, rate_limit_ratio=args.upstream_429), github_port)
+
+    # ההגדרות נקראות בזמן import של server, לכן הן נקבעות לפניו
+    os.environ.update({
+        "RENDER_API_BASE": f"http://127.0.0.1:{render_port}/v1",
+        "GITHUB_API_BASE": f"http://127.0.0.1:{github_port}",
+        "RENDER_API_KEY": "bench", "RENDER_SERVICE_ID": "srv-bench", "RENDER_OWNER_ID": "own-bench",
+        "GITHUB_TOKEN": "bench", "GITHUB_REPO": "bench/bench",
+        "SEMANTIC_INDEX_DIR": os.environ.get("SEMANTIC_INDEX_DIR", tempfile.mkdtemp(prefix="bench-index-")),
+    })
+    if args.mongomock:
+        os.environ.update({"CACHE_CHANGE_STREAM": "false", "CODE_COMPRESS_MIGRATE": "false"})
+
+    import server
+
+    for noisy in ("httpx", "mcp"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+    if args.mongomock:
+        import mongomock
+
+        server._collection = mongomock.MongoClient()[server.DB_NAME][server.COLLECTION_NAME]
+        server._mongo_pid = os.getpid()
+    col = server.get_collection()
+    seed(col, args.snippets)
+    sample_ids = [str(d["_id"]) for d in col.find({"source": "bench"}, {"_id": 1}).limit(1000)]
+
+    _serve_in_thread(server.create_app(), server_port)
+    base_url = f"http://127.0.0.1:{server_port}"
+    while not server._readiness["ready"]:
+        time.sleep(0.1)
+
+    tools = scenario(sample_ids)
+    selected = [t.strip() for t in args.tools.split(",") if t.strip()] or list(tools)
+    results = {}
+    print(f"\n{'tool':<28}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'err':>6}")
+    for key in selected:
+        r = asyncio.run(run_tool(base_url, key, tools[key], args.requests, args.concurrency))
+        results[key] = r
+        print(f"{key:<28}{r['rps']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['errors']:>6}")
+    col.delete_many({"tags": "bench-write"})
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": {"snippets": args.snippets, "requests": args.requests, "concurrency": args.concurrency,
+                   "mongo": "mongomock" if args.mongomock else "mongod",
+                   "upstream_latency_ms": args.upstream_latency, "upstream_429": args.upstream_429},
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n· baseline נשמר ב-{args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n✗ רגרסיות מול ה-baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\n✓ אין רגרסיות מול ה-baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Micro-benchmark לסריאליזציה של תשובות עם רשימות snippets.
+─────────────────────────────────────────────────────────────
+משווה את המסלול הקודם (serialize_doc לכל מסמך + json.dumps של stdlib למדידת
+התקציב) מול serialize_docs + json_dumps, ומודד גם וריאנט RawBSONDocument.
+המסמכים מקודדים ל-BSON מראש, כך שכל מסלול כולל את הפענוח כמו ב-cursor אמיתי.
+
+דוגמה:
+    python bench/serialization.py --docs 500 --code-lines 40
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SEMANTIC_INDEX_DIR", tempfile.mkdtemp(prefix="bench-index-"))
+
+import pydantic_core  # noqa: E402
+from bson import ObjectId, decode, encode  # noqa: E402
+from bson.raw_bson import RawBSONDocument  # noqa: E402
+
+import server  # noqa: E402
+
+
+def legacy_serialize_doc(doc: dict) -> dict:
+    """serialize_doc כפי שהיה לפני המסלול המהיר."""
+    server.unpack_code(doc)
+    doc["_id"] = str(doc["_id"])
+    for field in ("created_at", "updated_at"):
+        if field in doc and isinstance(doc[field], datetime):
+            doc[field] = doc[field].isoformat()
+    return doc
+
+
+def raw_serialize(raw: bytes) -> dict:
+    doc = RawBSONDocument(raw)
+    return {k: (str(v) if k == "_id" else v.isoformat() if isinstance(v, datetime) else v) for k, v in doc.items()}
+
+
+def make_docs(count: int, code_lines: int) -> list[bytes]:
+    now = datetime.now().replace(microsecond=123000)
+    docs = []
+    for i in range(count):
+        created = now - timedelta(minutes=i)
+        docs.append(encode({
+            "_id": ObjectId(),
+            "title": f"snippet {i}",
+            "code": "def handler(event):\n    return process(event)\n" * code_lines,
+            "language": "python",
+            "description": "retry with exponential backoff " * 4,
+            "tags": ["retry", "http", "async"],
+            "created_at": created,
+            "updated_at": created if i % 3 else now,
+            "source": "mcp",
+        }))
+    return docs
+
+
+def timed(fn, repeat: int) -> float:
+    fn()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serialization micro-benchmark")
+    parser.add_argument("--docs", type=int, default=500)
+    parser.add_argument("--code-lines", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    raws = make_docs(args.docs, args.code_lines)
+
+    def legacy():
+        result = {"count": len(raws), "snippets": [legacy_serialize_doc(decode(r)) for r in raws]}
+        len(json.dumps(result, ensure_ascii=False, default=str).encode())  # מדידת תקציב
+        return pydantic_core.to_json(result, fallback=str, indent=2)  # ה-framework
+
+    def fast():
+        result = {"count": len(raws), "snippets": server.serialize_docs([decode(r) for r in raws])}
+        len(server.json_dumps(result))
+        return pydantic_core.to_json(result, fallback=str, indent=2)
+
+    def raw_bson():
+        result = {"count": len(raws), "snippets": [raw_serialize(r) for r in raws]}
+        len(server.json_dumps(result))
+        return pydantic_core.to_json(result, fallback=str, indent=2)
+
+    assert json.loads(legacy()) == json.loads(fast()), "המסלולים מחזירים תוכן שונה"
+
+    encoder = "orjson" if server.orjson is not None else "pydantic_core"
+    print(f"{args.docs} docs × {args.code_lines} code lines, encoder: {encoder}\n")
+    print(f"{'path':<44}{'ms':>10}")
+    baseline = None
+    for label, fn in (
+        ("legacy: serialize_doc + json.dumps", legacy),
+        ("fast: serialize_docs + json_dumps", fast),
+        ("variant: RawBSONDocument one-pass", raw_bson),
+    ):
+        ms = timed(fn, args.repeat)
+        baseline = baseline or ms
+        print(f"{label:<44}{ms:>10.2f}   ×{baseline / ms:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+שרתי ASGI מקומיים שמחקים את Render API ו-GitHub API לצורכי benchmark.
+כל stub מוסיף השהיה מוגדרת ומחזיר 429 בהסתברות מוגדרת, כדי למדוד את
+השרת מול upstream איטי או מוגבל בלי לגעת בשירותים האמיתיים.
+"""
+
+import asyncio
+import random
+from datetime import datetime, timezone
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _make_app(routes: list[Route], latency_ms: float, jitter_ms: float, rate_limit_ratio: float) -> Starlette:
+    async def delay_and_limit(request, call_next):
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+        if rate_limit_ratio and random.random() < rate_limit_ratio:
+            return JSONResponse({"message": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+        return await call_next(request)
+
+    return Starlette(routes=routes, middleware=[Middleware(BaseHTTPMiddleware, dispatch=delay_and_limit)])
+
+
+def render_stub(latency_ms: float = 80, jitter_ms: float = 20, rate_limit_ratio: float = 0.0) -> Starlette:
+    """Render API מדומה - נתיבים תחת /v1 כמו RENDER_API_BASE."""
+
+    async def owners(request):
+        return JSONResponse([{"owner": {"id": "own-bench", "name": "bench"}}])
+
+    async def service(request):
+        sid = request.path_params["sid"]
+        return JSONResponse({
+            "id": sid, "name": "codebot-bench", "type": "web_service", "suspended": "not_suspended",
+            "serviceDetails": {"url": "https://bench.onrender.com"}, "region": "frankfurt",
+            "createdAt": _now(), "updatedAt": _now(), "autoDeploy": "yes",
+        })
+
+    async def deploys(request):
+        if request.method == "POST":
+            return JSONResponse({"id": "dep-bench", "status": "created"}, status_code=201)
+        limit = int(request.query_params.get("limit", 5))
+        return JSONResponse([
+            {"deploy": {"id": f"dep-{i}", "status": "live", "trigger": "api",
+                        "commit": {"id": f"{i:040x}", "message": f"commit {i}"},
+                        "createdAt": _now(), "finishedAt": _now()}}
+            for i in range(limit)
+        ])
+
+    async def restart(request):
+        return JSONResponse({}, status_code=200)
+
+    async def env_vars(request):
+        return JSONResponse([{"envVar": {"key": f"VAR_{i}", "value": f"value-{i}"}} for i in range(20)])
+
+    async def logs(request):
+        limit = int(request.query_params.get("limit", 100))
+        return JSONResponse({
+            "hasMore": True,
+            "nextStartTime": _now(),
+            "nextEndTime": _now(),
+            "logs": [
+                {"timestamp": _now(), "message": f"GET /mcp 200 {i}ms " + "x" * 120,
+                 "labels": [{"name": "level", "value": "info"}, {"name": "type", "value": "app"},
+                            {"name": "instance", "value": "srv-bench-1"}, {"name": "host", "value": "bench"}]}
+                for i in range(limit)
+            ],
+        })
+
+    routes = [
+        Route("/v1/owners", owners),
+        Route("/v1/services/{sid}", service),
+        Route("/v1/services/{sid}/deploys", deploys, methods=["GET", "POST"]),
+        Route("/v1/services/{sid}/restart", restart, methods=["POST"]),
+        Route("/v1/services/{sid}/env-vars", env_vars),
+        Route("/v1/logs", logs),
+    ]
+    return _make_app(routes, latency_ms, jitter_ms, rate_limit_ratio)
+
+
+def github_stub(latency_ms: float = 60, jitter_ms: float = 15, rate_limit_ratio: float = 0.0) -> Starlette:
+    """GitHub API מדומה - Issues ו-rate_limit."""
+
+    async def issues(request):
+        if request.method == "POST":
+            body = await request.json()
+            return JSONResponse({"number": 1, "html_url": "https://github.com/bench/bench/issues/1",
+                                 "title": body.get("title")}, status_code=201)
+        per_page = int(request.query_params.get("per_page", 10))
+        return JSONResponse([
+            {"number": i, "title": f"Issue {i}", "state": "open", "labels": [{"name": "bug"}],
+             "created_at": _now(), "html_url": f"https://github.com/bench/bench/issues/{i}"}
+            for i in range(per_page)
+        ])
+
+    async def rate_limit(request):
+        return JSONResponse({"resources": {"core": {"limit": 5000, "remaining": 4999}}})
+
+    routes = [
+        Route("/repos/{owner}/{repo}/issues", issues, methods=["GET", "POST"]),
+        Route("/rate_limit", rate_limit),
+    ]
+    return _make_app(routes, latency_ms, jitter_ms, rate_limit_ratio)
@@ -5,18 +5,63 @@ CodeBot MCP Server v2 - Streamable HTTP
 כולל: Render API, GitHub Issues, ניתוח קוד, ופרומפטים מובנים.
 """
 
+import time
+_BOOT_STARTED = time.perf_counter()  # תחילת ייבוא המודול - בסיס לדוח זמני העלייה ב-/health
+
 import os
+import asyncio
 import logging
 import json
 import re
-from datetime import datetime, timezone
+import sys
+import bisect
+import collections
+import contextlib
+import contextvars
+import difflib
+import functools
+import heapq
+import hmac
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import httpx
 from mcp.server.fastmcp import FastMCP
 from mcp.server.transport_security import TransportSecuritySettings
-from pymongo import MongoClient
-from bson import ObjectId
+import pydantic_core
+import pymongo
+from pymongo import InsertOne, MongoClient, ReplaceOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError, WriteConcernError, WriteError
+from pymongo.write_concern import WriteConcern
+import bson
+from bson import Binary, ObjectId, json_util
+
+try:
+    from re import _parser as _sre_parser
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parser
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import regex as _regex_engine  # תומך ב-timeout להתאמה
+except ImportError:
+    _regex_engine = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numpy נטען בשימוש הראשון באינדקס הסמנטי (load/rebuild), לא בעליית התהליך
+np = None
+
+_startup = {"import_ms": round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)}
 
 # ── הגדרות ─────────────────────────────────────────────────
 MONGO_URI = os.environ.get("MONGO_URI", "")
@@ -28,12 +73,84 @@ PORT = int(os.environ.get("PORT", 8000))
 RENDER_API_KEY = os.environ.get("RENDER_API_KEY", "")
 RENDER_SERVICE_ID = os.environ.get("RENDER_SERVICE_ID", "")
 RENDER_OWNER_ID = os.environ.get("RENDER_OWNER_ID", "")
-RENDER_API_BASE = "https://api.render.com/v1"
+RENDER_API_BASE = os.environ.get("RENDER_API_BASE", "https://api.render.com/v1")
 
 # GitHub API
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN", "")
 GITHUB_REPO = os.environ.get("GITHUB_REPO", "")  # owner/repo
-GITHUB_API_BASE = "https://api.github.com"
+GITHUB_API_BASE = os.environ.get("GITHUB_API_BASE", "https://api.github.com")
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+
+# תהליכי worker - WEB_CONCURRENCY כמו ב-Render/Heroku
+WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+GRACEFUL_SHUTDOWN_SECONDS = int(os.environ.get("GRACEFUL_SHUTDOWN_SECONDS", 25))
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "true").lower() == "true"
+
+# בדיקות בריאות ברקע
+HEALTH_PROBE_INTERVAL = int(os.environ.get("HEALTH_PROBE_INTERVAL", 15))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT", 2))
+HEALTH_PROBE_EXTERNAL = os.environ.get("HEALTH_PROBE_EXTERNAL", "false").lower() == "true"
+
+# חיפוש סמנטי מקומי
+SEMANTIC_INDEX_DIR = os.environ.get("SEMANTIC_INDEX_DIR", ".semantic_index")
+SEMANTIC_DIM = int(os.environ.get("SEMANTIC_DIM", 512))
+SEMANTIC_FLUSH_SECONDS = int(os.environ.get("SEMANTIC_FLUSH_SECONDS", 60))
+
+# דחיסת קוד גדול
+CODE_COMPRESS_THRESHOLD = int(os.environ.get("CODE_COMPRESS_THRESHOLD", 32 * 1024))
+CODE_COMPRESS_MIGRATE = os.environ.get("CODE_COMPRESS_MIGRATE", "true").lower() == "true"
+COMPRESSED_SCAN_MAX_MS = int(os.environ.get("COMPRESSED_SCAN_MAX_MS", 1000))
+
+# קוהרנטיות cache - change stream עם fallback ל-TTL
+CACHE_CHANGE_STREAM = os.environ.get("CACHE_CHANGE_STREAM", "true").lower() == "true"
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 60))
+SEMANTIC_REFRESH_SECONDS = int(os.environ.get("SEMANTIC_REFRESH_SECONDS", 600))
+
+# היסטוריית גרסאות - snapshot מלא כל N גרסאות
+SNIPPET_SNAPSHOT_EVERY = max(1, int(os.environ.get("SNIPPET_SNAPSHOT_EVERY", 10)))
+
+# אצוות כתיבה ל-create_snippet ו-write concern לכתיבות חדשות
+WRITE_COALESCE = os.environ.get("WRITE_COALESCE", "false").lower() == "true"
+WRITE_COALESCE_MS = float(os.environ.get("WRITE_COALESCE_MS", 5))
+WRITE_COALESCE_MAX = int(os.environ.get("WRITE_COALESCE_MAX", 100))
+WRITE_CONCERN_W = os.environ.get("WRITE_CONCERN_W", "")  # למשל 1 / majority
+WRITE_CONCERN_J = os.environ.get("WRITE_CONCERN_J", "")  # true / false
+
+# פרופיילינג - פירוק זמנים לכל קריאה (לכל הקריאות, או לפי header בבקשה)
+PROFILE_TOOLS = os.environ.get("PROFILE_TOOLS", "false").lower() == "true"
+PROFILE_HEADER = "x-codebot-profile"
+SLOW_CALL_MS = int(os.environ.get("SLOW_CALL_MS", 2000))
+PROFILE_MAX_SECONDS = 60
+
+# תקציב גודל תשובה - בבתים, או לפי הערכת טוקנים (~4 בתים לטוקן). 0 = ללא הגבלה
+RESPONSE_MAX_BYTES = int(os.environ.get("RESPONSE_MAX_BYTES", 64 * 1024))
+RESPONSE_MAX_TOKENS = int(os.environ.get("RESPONSE_MAX_TOKENS", 0))
+RESPONSE_BUDGET_BYTES = min(filter(None, (RESPONSE_MAX_BYTES, RESPONSE_MAX_TOKENS * 4)), default=0)
+RESPONSE_FIELD_MAX_CHARS = int(os.environ.get("RESPONSE_FIELD_MAX_CHARS", 4000))
+
+# ייצוא/ייבוא - נתיבי ניהול פעילים רק כשמוגדר טוקן
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+EXPORT_CHUNK_BYTES = 256 * 1024
+
+# מגבלות על שאילתות - זמן מקסימלי ל-Mongo וגודל regex
+MONGO_MAX_TIME_MS = int(os.environ.get("MONGO_MAX_TIME_MS", 3000))
+REGEX_MAX_LENGTH = int(os.environ.get("REGEX_MAX_LENGTH", 256))
+REGEX_SCAN_TIMEOUT_MS = int(os.environ.get("REGEX_SCAN_TIMEOUT_MS", 200))
+# בלי חבילת regex אין timeout להתאמה - במקום זה נבדקים רק התווים הראשונים של כל קוד
+REGEX_FALLBACK_MAX_CHARS = 64 * 1024
+TOOL_TIME_BUDGETS_MS = {
+    "get_snippet": 1000,
+    "create_snippet": 2000,
+    "update_snippet": 2000,
+    "delete_snippet": 2000,
+    "list_snippets": MONGO_MAX_TIME_MS,
+    "search_by_code": MONGO_MAX_TIME_MS * 2,
+    "semantic_search": MONGO_MAX_TIME_MS,
+    "get_stats": MONGO_MAX_TIME_MS * 2,
+    "analyze_snippet": 1000,
+    "bulk_tag_snippets": MONGO_MAX_TIME_MS * 4,
+    "suggest_facets": MONGO_MAX_TIME_MS * 4,  # בנייה ראשונה בלבד; אחריה אין גישה ל-Mongo
+}
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("codebot-mcp")
@@ -41,31 +158,1812 @@ logger = logging.getLogger("codebot-mcp")
 # ── MongoDB ─────────────────────────────────────────────────
 _mongo_client: Optional[MongoClient] = None
 _collection = None
+_mongo_pid: Optional[int] = None
+
+# קודי שגיאה של change streams: 40573 = לא replica set, 286/280 = ה-resume token כבר לא ב-oplog
+_CHANGE_STREAM_UNSUPPORTED = (40573, 40415)
+# 260: token שהשרת לא מקבל (למשל token של אירוע invalidate מגרסה קודמת)
+_CHANGE_STREAM_HISTORY_LOST = (286, 280, 260)
 
 
 def get_collection():
-    global _mongo_client, _collection
+    global _mongo_client, _collection, _mongo_pid, _versions_collection
+    if _collection is not None and _mongo_pid != os.getpid():
+        # MongoClient לא בטוח לשימוש אחרי fork - כל תהליך פותח pool משלו
+        _mongo_client = _collection = _versions_collection = None
     if _collection is None:
         if not MONGO_URI:
             raise RuntimeError("MONGO_URI לא הוגדר")
-        _mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        _mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000,
+                                    event_listeners=[_MongoSpanListener()])
         _collection = _mongo_client[DB_NAME][COLLECTION_NAME]
+        _mongo_pid = os.getpid()
         logger.info(f"MongoDB מחובר: {DB_NAME}/{COLLECTION_NAME}")
+        if CODE_COMPRESS_MIGRATE:
+            threading.Thread(target=migrate_code_compression, args=(_collection,),
+                             name="code-compression-migration", daemon=True).start()
     return _collection
 
 
+# ── סריאליזציה ─────────────────────────────────────────────
+# מסמכים מ-Mongo מומרים במקום (בלי dict ביניים) במעבר אחד: _id למחרוזת, תאריכים
+# ל-ISO, ופתיחת קוד דחוס רק כשיש סמן codec. ב-snippet שלא עודכן updated_at זהה
+# ל-created_at, ומחרוזת ה-ISO מחושבת פעם אחת. bench/serialization.py משווה מול
+# המסלול הקודם.
+
+def json_dumps(value) -> bytes:
+    """קידוד JSON (UTF-8) מהיר: orjson כשמותקן, אחרת pydantic_core שמגיע עם mcp. טיפוסים לא מוכרים → str."""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return pydantic_core.to_json(value, fallback=str)
+
+
+def _to_json_doc(doc: dict) -> dict:
+    if "code_codec" in doc:
+        unpack_code(doc)
+    doc["_id"] = str(doc["_id"])
+    created = doc.get("created_at")
+    updated = doc.get("updated_at")
+    if isinstance(created, datetime):
+        doc["created_at"] = created.isoformat()
+    if isinstance(updated, datetime):
+        doc["updated_at"] = doc["created_at"] if updated == created else updated.isoformat()
+    return doc
+
+
 def serialize_doc(doc: dict) -> dict:
     if doc is None:
         return {}
-    doc["_id"] = str(doc["_id"])
-    for field in ("created_at", "updated_at"):
-        if field in doc and isinstance(doc[field], datetime):
-            doc[field] = doc[field].isoformat()
+    with span("serialize"):
+        return _to_json_doc(doc)
+
+
+def serialize_docs(docs: list[dict]) -> list[dict]:
+    """סריאליזציה של רשימת מסמכים - span אחד לכל הרשימה במקום לכל מסמך."""
+    with span("serialize"):
+        return [_to_json_doc(d) for d in docs]
+
+
+# ── דחיסת גוף הקוד ─────────────────────────────────────────
+# קוד מעל CODE_COMPRESS_THRESHOLD בתים נשמר כ-BSON binary דחוס עם סמן codec,
+# ונפתח רק כשהגוף באמת נדרש. snippets קטנים נשמרים כמחרוזת רגילה כמו תמיד.
+
+_CODE_CODEC_FIELDS = ("code_codec", "code_size", "code_stored_size")
+_codec_stats = {"decompress_count": 0, "decompress_ms": 0.0}
+
+
+def pack_code(code: str) -> tuple[dict, dict]:
+    """מחזיר (שדות ל-$set, שדות ל-$unset) עבור גוף קוד חדש."""
+    raw = code.encode()
+    if len(raw) < CODE_COMPRESS_THRESHOLD:
+        return {"code": code}, {f: "" for f in _CODE_CODEC_FIELDS}
+    if zstandard:
+        codec, packed = "zstd", zstandard.ZstdCompressor(level=6).compress(raw)
+    else:
+        codec, packed = "zlib", zlib.compress(raw, 6)
+    return {
+        "code": Binary(packed),
+        "code_codec": codec,
+        "code_size": len(raw),
+        "code_stored_size": len(packed),
+    }, {}
+
+
+def unpack_code(doc: Optional[dict]) -> Optional[dict]:
+    """פתיחת גוף קוד דחוס במקום (in-place) והסרת שדות הסמן."""
+    if not doc or not doc.get("code_codec"):
+        return doc
+    started = time.perf_counter()
+    codec = doc["code_codec"]
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("snippet דחוס ב-zstd אבל החבילה zstandard לא מותקנת")
+        raw = zstandard.ZstdDecompressor().decompress(bytes(doc["code"]))
+    else:
+        raw = zlib.decompress(doc["code"])
+    doc["code"] = raw.decode()
+    for f in _CODE_CODEC_FIELDS:
+        doc.pop(f, None)
+    _codec_stats["decompress_count"] += 1
+    _codec_stats["decompress_ms"] += (time.perf_counter() - started) * 1000
     return doc
 
 
+def compile_code_regex(pattern: str):
+    """הידור ביטוי לחיפוש בצד השרת - בחבילת regex (עם timeout) כשהיא מותקנת."""
+    if _regex_engine:
+        return _regex_engine.compile(pattern, _regex_engine.IGNORECASE)
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _regex_timeout(limit_ms: Optional[float] = None) -> float:
+    return max(1.0, min(REGEX_SCAN_TIMEOUT_MS, limit_ms if limit_ms is not None else REGEX_SCAN_TIMEOUT_MS)) / 1000
+
+
+def bounded_search(regex, text: str, limit_ms: Optional[float] = None):
+    """
+    search עם גבול זמן: REGEX_SCAN_TIMEOUT_MS (או limit_ms אם קטן יותר).
+    זורק TimeoutError כשהגבול עובר. בלי חבילת regex - נבדקים רק REGEX_FALLBACK_MAX_CHARS תווים.
+    """
+    if _regex_engine:
+        return regex.search(text, timeout=_regex_timeout(limit_ms))
+    return regex.search(text[:REGEX_FALLBACK_MAX_CHARS])
+
+
+def bounded_finditer(regex, text: str, limit_ms: Optional[float] = None):
+    """כמו bounded_search, ל-finditer (הגבול חל על כל המעבר)."""
+    if _regex_engine:
+        return regex.finditer(text, timeout=_regex_timeout(limit_ms))
+    return regex.finditer(text[:REGEX_FALLBACK_MAX_CHARS])
+
+
+def compressed_code_matches(col, pattern: str, base: Optional[dict] = None,
+                            skip_fields: tuple[str, ...] = (), warnings: Optional[list[str]] = None) -> list:
+    """
+    $regex של Mongo לא רואה גוף דחוס, לכן snippets דחוסים נבדקים כאן בצד השרת.
+    נפתחים רק snippets שעוברים את שאר הסינון (base) ושלא תואמים כבר דרך skip_fields,
+    והסריקה נעצרת אחרי COMPRESSED_SCAN_MAX_MS. מחזיר רשימת _id שהקוד שלהם תואם לביטוי.
+    """
+    regex = compile_code_regex(pattern)
+    query = {**(base or {}), "code_codec": {"$exists": True}}
+    if skip_fields:
+        query["$nor"] = [{f: {"$regex": pattern, "$options": "i"}} for f in skip_fields]
+    deadline = time.perf_counter() + COMPRESSED_SCAN_MAX_MS / 1000
+    ids = []
+    for doc in col.find(query, {"code": 1, "code_codec": 1}):
+        if time.perf_counter() > deadline:
+            if warnings is not None:
+                warnings.append(f"סריקת קוד דחוס נעצרה אחרי {COMPRESSED_SCAN_MAX_MS}ms - "
+                                "ייתכן שחסרות התאמות ב-snippets גדולים; צמצם עם language/tag")
+            break
+        remaining_ms = (deadline - time.perf_counter()) * 1000
+        try:
+            if bounded_search(regex, unpack_code(doc)["code"], remaining_ms):
+                ids.append(doc["_id"])
+        except TimeoutError:
+            if warnings is not None:
+                warnings.append(f"ההתאמה ל-snippet {doc['_id']} נעצרה אחרי מגבלת הזמן - הוא לא נכלל בתוצאות")
+    return ids
+
+
+def code_search_clause(col, pattern: str, fields: tuple[str, ...], base: Optional[dict] = None,
+                       warnings: Optional[list[str]] = None) -> list[dict]:
+    """
+    תנאי $or לחיפוש טקסט בשדות, כולל snippets עם קוד דחוס.
+
+    Args:
+        col: האוסף
+        pattern: הביטוי (אחרי guard_regex)
+        fields: השדות לחיפוש
+        base: שאר תנאי השאילתה - מצמצמים את סריקת הקוד הדחוס
+        warnings: רשימה לאזהרה אם סריקת הקוד הדחוס נקטעה
+    """
+    regex = {"$regex": pattern, "$options": "i"}
+    clauses = [{f: regex} for f in fields]
+    if "code" in fields:
+        others = tuple(f for f in fields if f != "code")
+        ids = compressed_code_matches(col, pattern, base, others, warnings)
+        if ids:
+            clauses.append({"_id": {"$in": ids}})
+    return clauses
+
+
+_MIGRATION_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def _claim_migration(migrations, name: str, threshold: int) -> bool:
+    """
+    תפיסת מיגרציה ל-worker אחד. מסמך הסימון נתפס כשאין כזה, כשהסף השתנה, או כשתפיסה
+    קודמת לא הושלמה ונטשה. אחרת ה-upsert מתנגש ב-_id הקיים - המיגרציה רצה או הושלמה.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        migrations.update_one(
+            {"_id": name, "$or": [
+                {"threshold": {"$ne": threshold}},
+                {"done": False, "claimed_at": {"$lt": now - _MIGRATION_CLAIM_TIMEOUT}},
+            ]},
+            {"$set": {"threshold": threshold, "done": False, "claimed_at": now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def migrate_code_compression(col, batch_size: int = 100):
+    """
+    מיגרציית רקע: דחיסת snippets קיימים שהקוד שלהם מעל הסף. רצה פעם אחת לכל סף -
+    worker אחד תופס אותה, וסיום נרשם באוסף המיגרציות כך שעליות הבאות מדלגות על הסריקה.
+    """
+    migrations = col.database[f"{COLLECTION_NAME}_migrations"]
+    try:
+        if not _claim_migration(migrations, "code_compression", CODE_COMPRESS_THRESHOLD):
+            return
+    except PyMongoError as e:
+        logger.warning(f"מיגרציית דחיסה לא התחילה: {e}")
+        return
+    query = {
+        "code": {"$type": "string"},
+        # $cond מחשב את $strLenBytes רק על מחרוזת - בלי תלות בסדר שבו השרת בודק את התנאים
+        "$expr": {"$gte": [
+            {"$cond": [{"$eq": [{"$type": "$code"}, "string"]}, {"$strLenBytes": "$code"}, 0]},
+            CODE_COMPRESS_THRESHOLD,
+        ]},
+    }
+    converted = 0
+    try:
+        while True:
+            docs = list(col.find(query, {"code": 1}).limit(batch_size))
+            if not docs:
+                break
+            batch_converted = 0
+            for doc in docs:
+                set_fields, _ = pack_code(doc["code"])
+                # התנאי על code מונע דריסה של עדכון שהגיע באמצע המיגרציה
+                result = col.update_one({"_id": doc["_id"], "code": doc["code"]}, {"$set": set_fields})
+                batch_converted += result.modified_count
+            if not batch_converted:
+                break
+            converted += batch_converted
+        migrations.update_one({"_id": "code_compression"},
+                              {"$set": {"done": True, "finished_at": datetime.now(timezone.utc),
+                                        "converted": converted}})
+    except PyMongoError as e:
+        # הסימון נשאר לא גמור - worker יתפוס אותו שוב אחרי _MIGRATION_CLAIM_TIMEOUT
+        logger.warning(f"מיגרציית דחיסה נעצרה: {e}")
+    if converted:
+        logger.info(f"מיגרציית דחיסה: {converted} snippets נדחסו")
+
+
+# ── היסטוריית גרסאות (deltas) ──────────────────────────────
+# כל עדכון קוד נשמר כגרסה באוסף נפרד: delta מבוסס שורות מול הגרסה הקודמת,
+# ו-snapshot מלא כל SNIPPET_SNAPSHOT_EVERY גרסאות. שחזור גרסה קורא רק את
+# השרשרת מה-snapshot הקרוב ומחיל לכל היותר SNIPPET_SNAPSHOT_EVERY-1 deltas.
+
+_versions_collection = None
+
+
+def get_versions_collection():
+    global _versions_collection
+    if _versions_collection is None:
+        col = get_collection()
+        _versions_collection = col.database[f"{COLLECTION_NAME}_versions"]
+        _versions_collection.create_index([("snippet_id", 1), ("version", 1)], unique=True)
+    return _versions_collection
+
+
+def make_delta(old: str, new: str) -> list:
+    """delta קומפקטי: רשימת [התחלה, סוף, שורות חדשות] מול שורות הגרסה הקודמת."""
+    a, b = old.split("\n"), new.split("\n")
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return [[i1, i2, b[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def apply_delta(old: str, delta: list) -> str:
+    lines = old.split("\n")
+    # החלה מהסוף להתחלה כדי שהאינדקסים של הגרסה הקודמת יישארו תקפים
+    for i1, i2, new_lines in reversed(delta):
+        lines[i1:i2] = new_lines
+    return "\n".join(lines)
+
+
+def _is_snapshot_version(version: int) -> bool:
+    return version == 1 or (version - 1) % SNIPPET_SNAPSHOT_EVERY == 0
+
+
+def record_version(snippet_id: ObjectId, version: int, old_code: str, new_code: str):
+    """
+    שמירת גרסה חדשה - snapshot או delta מול old_code.
+    נקרא רק אחרי שהעדכון המותנה של ה-snippet הצליח, כך שלכל גרסה יש כותב אחד.
+    """
+    entry = {"snippet_id": snippet_id, "version": version, "created_at": datetime.now(timezone.utc)}
+    if _is_snapshot_version(version):
+        entry["kind"] = "snapshot"
+        entry.update(pack_code(new_code)[0])
+    else:
+        entry["kind"] = "delta"
+        entry["delta"] = make_delta(old_code, new_code)
+    versions = get_versions_collection()
+    try:
+        versions.insert_one(entry)
+    except DuplicateKeyError:
+        # שארית מכתיבה שנקטעה לפני שה-snippet התקדם - הגרסה שייכת לעדכון הזה
+        logger.warning(f"גרסה {version} של {snippet_id} כבר הייתה באוסף הגרסאות - נדרסת")
+        entry.pop("_id", None)
+        versions.replace_one({"snippet_id": snippet_id, "version": version}, entry)
+
+
+def reconstruct_version(snippet_id: ObjectId, version: int) -> Optional[str]:
+    """שחזור קוד של גרסה: snapshot אחרון עד הגרסה + deltas עד אליה."""
+    base = version - (version - 1) % SNIPPET_SNAPSHOT_EVERY
+    chain = list(get_versions_collection().find(
+        {"snippet_id": snippet_id, "version": {"$gte": base, "$lte": version}},
+    ).sort("version", 1))
+    if not chain or chain[0]["kind"] != "snapshot" or len(chain) != version - base + 1:
+        return None
+    code = unpack_code(chain[0])["code"]
+    for entry in chain[1:]:
+        code = apply_delta(code, entry["delta"])
+    return code
+
+
+# ── אצוות כתיבה ל-create_snippet ───────────────────────────
+# במצב WRITE_COALESCE, קריאות create_snippet מקבילות ב-worker נאספות עד
+# WRITE_COALESCE_MS מילישניות או WRITE_COALESCE_MAX מסמכים, ונכתבות ב-insert_many
+# אחד (ordered=False) - round trip ו-commit אחד ל-journal לכל האצווה. ה-_id נקבע
+# מראש בצד הלקוח, כך שכל קורא מקבל את המזהה שלו, ושגיאת כתיבה של מסמך אחד
+# מגיעה רק לקורא שלו.
+
+def get_write_collection():
+    """האוסף עם ה-write concern מ-WRITE_CONCERN_W / WRITE_CONCERN_J (ברירת המחדל של השרת כשלא הוגדרו)."""
+    col = get_collection()
+    if not (WRITE_CONCERN_W or WRITE_CONCERN_J):
+        return col
+    w = int(WRITE_CONCERN_W) if WRITE_CONCERN_W.isdigit() else (WRITE_CONCERN_W or None)
+    j = WRITE_CONCERN_J.lower() == "true" if WRITE_CONCERN_J else None
+    return col.with_options(write_concern=WriteConcern(w=w, j=j))
+
+
+def _insert_batch(docs: list[dict]):
+    # רץ ב-thread עם context ריק - תקציב הזמן של האצווה, לא של הקורא הראשון
+    with pymongo.timeout(TOOL_TIME_BUDGETS_MS["create_snippet"] / 1000):
+        get_write_collection().insert_many(docs, ordered=False)
+
+
+class _InsertBatcher:
+    """תור הכנסות של event loop אחד. insert() מחזיר את ה-_id או זורק את שגיאת המסמך."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.pending: list[tuple[dict, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.stats = {"batches": 0, "documents": 0, "max_batch": 0, "errors": 0}
+
+    async def insert(self, doc: dict) -> ObjectId:
+        # קידוד מוקדם: מסמך שלא מתקודד ל-BSON (למשל surrogate בודד בכותרת) נכשל רק לקורא שלו
+        bson.encode(doc)
+        future = self.loop.create_future()
+        self.pending.append((doc, future))
+        if len(self.pending) >= WRITE_COALESCE_MAX:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(WRITE_COALESCE_MS / 1000, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            contextvars.Context().run(self.loop.create_task, self._write(batch))
+
+    async def _write(self, batch: list[tuple[dict, asyncio.Future]]):
+        doc_errors: dict[int, Exception] = {}
+        failure: Optional[Exception] = None
+        try:
+            await asyncio.to_thread(_insert_batch, [doc for doc, _ in batch])
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                doc_errors[err["index"]] = WriteError(err.get("errmsg", ""), err.get("code"), err)
+            wc_errors = e.details.get("writeConcernErrors")
+            if wc_errors:
+                failure = WriteConcernError(wc_errors[0].get("errmsg", ""), wc_errors[0].get("code"), wc_errors[0])
+        except asyncio.CancelledError:
+            failure = PyMongoError("אצוות ההכנסה בוטלה לפני שהסתיימה")
+            raise
+        except Exception as e:
+            failure = e
+        finally:
+            self._resolve(batch, doc_errors, failure)
+
+    def _resolve(self, batch: list[tuple[dict, asyncio.Future]], doc_errors: dict[int, Exception],
+                 failure: Optional[Exception]):
+        """שחרור כל הקוראים של האצווה - עם ה-_id, שגיאת המסמך או שגיאת האצווה."""
+        self.stats["batches"] += 1
+        self.stats["documents"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        for i, (doc, future) in enumerate(batch):
+            if future.done():  # הקורא בוטל בזמן ההמתנה
+                continue
+            error = doc_errors.get(i) or failure
+            if error:
+                self.stats["errors"] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(doc["_id"])
+
+
+_insert_batcher: Optional[_InsertBatcher] = None
+
+
+def get_insert_batcher() -> _InsertBatcher:
+    global _insert_batcher
+    loop = asyncio.get_running_loop()
+    if _insert_batcher is None or _insert_batcher.loop is not loop:
+        _insert_batcher = _InsertBatcher(loop)
+    return _insert_batcher
+
+
+# ── פרופיילינג ולוג קריאות איטיות ──────────────────────────
+# כשפרופיילינג פעיל (PROFILE_TOOLS או header בבקשה), כל קריאה לכלי אוספת זמני
+# wall-clock לפי סוג: mongo (דרך command monitoring של pymongo), http (event hooks
+# של httpx), serialize ו-analysis. הפירוק מוחזר בשדה profile של התשובה.
+# קריאה שחרגה מ-SLOW_CALL_MS נרשמת תמיד ל-slow log, עם הארגומנטים שלה.
+
+_profile_spans: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("profile_spans", default=None)
+_slow_calls: collections.deque = collections.deque(maxlen=100)
+slow_logger = logging.getLogger("codebot-mcp.slow")
+
+
+def _add_span(kind: str, ms: float):
+    spans = _profile_spans.get()
+    if spans is not None:
+        entry = spans.setdefault(kind, {"count": 0, "ms": 0.0})
+        entry["count"] += 1
+        entry["ms"] += ms
+
+
+@contextlib.contextmanager
+def span(kind: str):
+    """מדידת בלוק קוד כ-span מסוג kind (ללא עלות כשאין פרופיילינג פעיל)."""
+    if _profile_spans.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_span(kind, (time.perf_counter() - started) * 1000)
+
+
+class _MongoSpanListener(monitoring.CommandListener):
+    """זמן כל פקודת Mongo כפי שנמדד ע"י הדרייבר - האירועים נשלחים ב-thread של הקורא."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        _add_span("mongo", event.duration_micros / 1000)
+
+    def failed(self, event):
+        _add_span("mongo", event.duration_micros / 1000)
+
+
+async def _http_span_start(request: httpx.Request):
+    request.extensions["profile_started"] = time.perf_counter()
+
+
+async def _http_span_end(response: httpx.Response):
+    # נמדד עד קבלת ה-headers; קריאת הגוף קצרה ביחס להמתנה ל-upstream
+    started = response.request.extensions.get("profile_started")
+    if started is not None:
+        _add_span("http", (time.perf_counter() - started) * 1000)
+
+
+def _profiling_requested() -> bool:
+    if PROFILE_TOOLS:
+        return True
+    try:
+        request = mcp.get_context().request_context.request
+    except (LookupError, ValueError):
+        return False
+    value = request.headers.get(PROFILE_HEADER, "") if request is not None else ""
+    return value.lower() in ("1", "true", "yes")
+
+
+def _loggable_args(kwargs: dict) -> dict:
+    """ארגומנטים ללוג - מחרוזות ארוכות (למשל גוף קוד) מקוצרות."""
+    return {k: (v[:200] + f"… ({len(v)} תווים)" if isinstance(v, str) and len(v) > 200 else v)
+            for k, v in kwargs.items()}
+
+
+def _begin_call():
+    spans = {} if _profiling_requested() else None
+    return _profile_spans.set(spans), spans, time.perf_counter()
+
+
+def _end_call(name: str, kwargs: dict, token, spans: Optional[dict], started: float, result):
+    _profile_spans.reset(token)
+    total_ms = (time.perf_counter() - started) * 1000
+    profile = None
+    if spans is not None:
+        accounted = sum(entry["ms"] for entry in spans.values())
+        profile = {
+            "total_ms": round(total_ms, 2),
+            "spans": {k: {"count": v["count"], "ms": round(v["ms"], 2)} for k, v in spans.items()},
+            "other_ms": round(max(0.0, total_ms - accounted), 2),
+        }
+        if isinstance(result, dict):
+            # עותק - התשובה עשויה להיות אובייקט מה-cache
+            result = {**result, "profile": profile}
+    if total_ms >= SLOW_CALL_MS:
+        record = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "tool": name,
+            "duration_ms": round(total_ms, 2),
+            "args": _loggable_args(kwargs),
+            "profile": profile,
+            "pid": os.getpid(),
+        }
+        _slow_calls.append(record)
+        slow_logger.warning(json_dumps(record).decode())
+    return result
+
+
+def profiled(func):
+    """עטיפת כלי (סינכרוני או אסינכרוני) במדידת זמן, פירוק ל-spans ורישום קריאות איטיות."""
+    name = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            token, spans, started = _begin_call()
+            result = None
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                result = _end_call(name, kwargs, token, spans, started, result)
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token, spans, started = _begin_call()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            result = _end_call(name, kwargs, token, spans, started, result)
+        return result
+
+    return wrapper
+
+
+# ── תקציב גודל תשובה ───────────────────────────────────────
+# כל תשובת כלי נמדדת אחרי הריצה. מעל התקציב: שדות ארוכים בתוך רשימות נחתכים
+# ל-RESPONSE_FIELD_MAX_CHARS, ואז - לפי מה שתופס יותר מקום - זנב הרשימה הגדולה
+# נשמט או המחרוזת הארוכה מקוצרת, עד שהתשובה נכנסת. מה שהושמט מדווח בשדה omitted
+# (ולא truncated - search_by_code כבר מחזיר truncated בוליאני משלו).
+
+_CONTINUATION_HINTS = {
+    "list_snippets": "צמצם עם language/tag/search או הקטן את limit",
+    "search_by_code": "סנן לפי language, הקטן את context_lines, או פתח תוצאה בודדת עם get_snippet",
+    "semantic_search": "הקטן את limit או סנן לפי language",
+    "render_get_logs": "להמשך קרא שוב מ-{last[timestamp]} (end_time ב-backward, start_time ב-forward) או הקטן את limit",
+    "github_list_issues": "הקטן את limit או סנן לפי state/labels",
+    "get_snippet": "הגוף המלא חורג מהתקציב - קרא אותו בחלקים עם start_line/max_lines (למשל 300 שורות בכל קריאה)",
+    "get_snippet_version": "הגוף המלא חורג מהתקציב - קרא אותו בחלקים עם start_line/max_lines (למשל 300 שורות בכל קריאה)",
+}
+_DEFAULT_HINT = "הקטן את limit או צמצם את הסינון"
+
+
+def _json_size(value) -> int:
+    return len(json_dumps(value))
+
+
+def _walk_nodes(value, path: str = ""):
+    """(path, container, key, value) לכל צומת מתחת ל-value."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return
+    for key, child in items:
+        child_path = f"{path}[{key}]" if isinstance(value, list) else (f"{path}.{key}" if path else str(key))
+        yield child_path, value, key, child
+        yield from _walk_nodes(child, child_path)
+
+
+_FIT_MIN_CHARS = 200
+_FIT_MAX_ROUNDS = 64
+_CUT_MARKER = re.compile(r"… \[נחתכו \d+ תווים\]$")
+
+
+def _cut(value: str, keep: int, original_len: int) -> str:
+    return value[:keep] + f"… [נחתכו {original_len - keep} תווים]"
+
+
+def _kept_chars(value: str) -> int:
+    """אורך התוכן המקורי שנשאר במחרוזת, בלי סימון החיתוך אם כבר נחתכה."""
+    marker = _CUT_MARKER.search(value)
+    return marker.start() if marker else len(value)
+
+
+def fit_response(result: dict, max_bytes: int, tool: str = "") -> dict:
+    """
+    הקטנת תשובה לתקציב max_bytes (JSON, UTF-8). תשובה שנכנסת מוחזרת כמו שהיא.
+
+    Args:
+        result: תשובת הכלי
+        max_bytes: תקציב בבתים
+        tool: שם הכלי, לרמז ההמשך
+    """
+    original_bytes = _json_size(result)
+    if original_bytes <= max_bytes:
+        return result
+    result = json.loads(json_dumps(result))  # עותק עמוק - מהיר מ-deepcopy ובטיפוסים שהלקוח יראה
+    target = max(max_bytes - 512, max_bytes // 2)  # מקום לדיווח עצמו
+    fields: dict[str, int] = {}
+    lists: dict[str, dict] = {}
+
+    for path, parent, key, value in list(_walk_nodes(result)):
+        if isinstance(value, str) and len(value) > RESPONSE_FIELD_MAX_CHARS and "[" in path:
+            fields[path] = len(value)
+            parent[key] = _cut(value, RESPONSE_FIELD_MAX_CHARS, len(value))
+
+    size = _json_size(result)
+    for _ in range(_FIT_MAX_ROUNDS):
+        if size <= target:
+            break
+        nodes = list(_walk_nodes(result))
+        # רק מחרוזות שאפשר עוד לקצר - מחרוזת שכבר נחתכה ל-200 תווים לא תקטן שוב
+        longest = max((n for n in nodes if isinstance(n[3], str) and _kept_chars(n[3]) > _FIT_MIN_CHARS),
+                      key=lambda n: len(n[3]), default=None)
+        biggest = max((n for n in nodes if isinstance(n[3], list) and len(n[3]) > 1),
+                      key=lambda n: _json_size(n[3]), default=None)
+        excess = size - target
+        if biggest and (not longest or _json_size(biggest[3]) > len(longest[3].encode())):
+            path, _, _, items = biggest
+            keep, removed = len(items), 0
+            while keep > 1 and removed < excess:
+                keep -= 1
+                removed += _json_size(items[keep]) + 1
+            lists.setdefault(path, {"path": path, "total": len(items)})["kept"] = keep
+            del items[keep:]
+        elif longest:
+            path, parent, key, value = longest
+            kept = _kept_chars(value)
+            original_len = fields.setdefault(path, kept)
+            # escaping (\n, מרכאות) ותווים מרובי-בתים - בתים לתו לפי המחרוזת עצמה
+            bytes_per_char = _json_size(value[:kept]) / kept
+            parent[key] = _cut(value, max(_FIT_MIN_CHARS, kept - int(excess / bytes_per_char) - 64), original_len)
+        else:
+            break
+        size = _json_size(result)
+
+    report = {"original_bytes": original_bytes, "returned_bytes": size}
+    if fields:
+        report["fields"] = [{"path": p, "original_chars": n} for p, n in list(fields.items())[:20]]
+        report["fields_count"] = len(fields)
+    if lists:
+        report["lists"] = list(lists.values())
+    last = next((v[-1] for p, _, _, v in _walk_nodes(result) if p in lists and v), {})
+    try:
+        report["hint"] = _CONTINUATION_HINTS.get(tool, _DEFAULT_HINT).format(last=last)
+    except (KeyError, TypeError):
+        report["hint"] = _DEFAULT_HINT
+    result["omitted"] = report
+    return result
+
+
+def with_response_budget(func):
+    """הפעלת fit_response על תשובת הכלי (סינכרוני או אסינכרוני) לפי RESPONSE_MAX_BYTES."""
+    name = func.__name__
+
+    def _fit(result):
+        if RESPONSE_BUDGET_BYTES and isinstance(result, dict):
+            with span("serialize"):
+                return fit_response(result, RESPONSE_BUDGET_BYTES, name)
+        return result
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return _fit(await func(*args, **kwargs))
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return _fit(func(*args, **kwargs))
+
+    return wrapper
+
+
+# ── הגנות על שאילתות ───────────────────────────────────────
+# כל כלי שניגש ל-Mongo רץ בתוך תקציב זמן (CSOT של pymongo), שמתורגם ל-maxTimeMS
+# בכל find/aggregate/count_documents. ביטויים רגולריים מהמשתמש עוברים בדיקה
+# מקדימה לפני שהם נשלחים ל-$regex.
+
+def with_time_budget(func):
+    """הרצת כלי בתוך תקציב maxTimeMS לפי שמו, והחזרת שגיאה מסודרת בחריגה."""
+    budget_ms = TOOL_TIME_BUDGETS_MS.get(func.__name__, MONGO_MAX_TIME_MS)
+
+    def timed_out() -> dict:
+        logger.warning(f"{func.__name__} חרג מתקציב הזמן ({budget_ms}ms)")
+        return {"error": f"השאילתה חרגה ממגבלת הזמן ({budget_ms}ms) - נסה סינון ממוקד יותר"}
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                with pymongo.timeout(budget_ms / 1000):
+                    return await func(*args, **kwargs)
+            except PyMongoError as e:
+                if not e.timeout:
+                    raise
+                return timed_out()
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with pymongo.timeout(budget_ms / 1000):
+                return func(*args, **kwargs)
+        except PyMongoError as e:
+            if not e.timeout:
+                raise
+            return timed_out()
+
+    return wrapper
+
+
+def _regex_risk(parsed) -> Optional[str]:
+    """
+    חיפוש מבנים שגורמים ל-backtracking קטסטרופלי ב-PCRE של Mongo: כמת על גוף שיכול
+    להיות ריק או באורך משתנה (כולל כמתים מקוננים), חלופות חופפות תחת כמת, backreference.
+    """
+    for op, av in _walk_regex(parsed):
+        name = str(op)
+        if name == "GROUPREF":
+            return "backreference"
+        if name in ("MAX_REPEAT", "MIN_REPEAT") and av[1] > 1:
+            lo, hi = av[2].getwidth()
+            if lo == 0:
+                return "כמת על גוף שיכול להיות ריק (למשל (a?){20} או (a*)*)"
+            if lo != hi:
+                return "כמת על גוף באורך משתנה (למשל (a+)+ או (a|ab)*)"
+            for inner_op, inner_av in _walk_regex(av[2]):
+                if str(inner_op) == "BRANCH" and _branches_overlap(inner_av[1]):
+                    return "חלופות חופפות בתוך כמת (למשל (\\w|_)+)"
+    return None
+
+
+# דגימת תווים לבדיקת חפיפה בין חלופות: ASCII ועוד כמה תווים מחוץ לו
+_SAMPLE_CHARS = [chr(c) for c in range(128)] + list("éßüΩא٣\u00a0")
+_CATEGORY_TESTS = {
+    "CATEGORY_DIGIT": str.isdigit,
+    "CATEGORY_NOT_DIGIT": lambda c: not c.isdigit(),
+    "CATEGORY_SPACE": str.isspace,
+    "CATEGORY_NOT_SPACE": lambda c: not c.isspace(),
+    "CATEGORY_WORD": lambda c: c.isalnum() or c == "_",
+    "CATEGORY_NOT_WORD": lambda c: not (c.isalnum() or c == "_"),
+}
+
+
+def _char_matches(op, av, ch: str) -> bool:
+    name = str(op)
+    if name == "LITERAL":
+        return ch == chr(av)
+    if name == "NOT_LITERAL":
+        return ch != chr(av)
+    if name == "ANY":
+        return ch != "\n"
+    if name == "RANGE":
+        return av[0] <= ord(ch) <= av[1]
+    if name == "CATEGORY":
+        return _CATEGORY_TESTS.get(str(av), lambda c: True)(ch)
+    if name == "IN":
+        negate = bool(av) and str(av[0][0]) == "NEGATE"
+        items = av[1:] if negate else av
+        return any(_char_matches(o, a, ch) for o, a in items) != negate
+    return True
+
+
+def _item_min_width(op, av) -> int:
+    name = str(op)
+    if name in ("AT", "ASSERT", "ASSERT_NOT"):
+        return 0
+    if name == "SUBPATTERN":
+        return av[-1].getwidth()[0]
+    if name == "BRANCH":
+        return min(branch.getwidth()[0] for branch in av[1])
+    if name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+        return av[0] * av[2].getwidth()[0]
+    return 1
+
+
+def _first_chars(seq) -> set[str]:
+    """התווים (מתוך הדגימה, בלי רגישות לאותיות) שבהם התאמה של הרצף יכולה להתחיל."""
+    chars: set[str] = set()
+    for op, av in seq:
+        name = str(op)
+        if name == "SUBPATTERN":
+            chars |= _first_chars(av[-1])
+        elif name == "BRANCH":
+            for branch in av[1]:
+                chars |= _first_chars(branch)
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            chars |= _first_chars(av[2])
+        elif name in ("LITERAL", "NOT_LITERAL", "ANY", "IN"):
+            return chars | {c for c in _SAMPLE_CHARS
+                            if _char_matches(op, av, c) or _char_matches(op, av, c.swapcase())}
+        elif name not in ("AT", "ASSERT", "ASSERT_NOT"):
+            return set(_SAMPLE_CHARS)
+        if _item_min_width(op, av) > 0:
+            return chars
+    # הרצף יכול להתאים למחרוזת ריקה - חופף לכל דבר
+    return set(_SAMPLE_CHARS)
+
+
+def _branches_overlap(branches) -> bool:
+    seen: set[str] = set()
+    for branch in branches:
+        first = _first_chars(branch)
+        if seen & first:
+            return True
+        seen |= first
+    return False
+
+
+def _mark_branches(pattern: str) -> str:
+    """
+    הוספת (?=) בסוף כל חלופה. ה-parser של Python הופך חלופות של תו בודד (למשל (\\w|_))
+    למחלקת תווים, אבל PCRE מריץ אותן כחלופות אמיתיות - הסמן משאיר אותן BRANCH לבדיקה.
+    """
+    out = []
+    i, in_class, class_start = 0, False, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            if ch == "]" and i > class_start:
+                in_class = False
+        elif ch == "[":
+            in_class = True
+            class_start = i + 1 + (pattern[i + 1:i + 2] == "^")
+        elif ch in "|)":
+            out.append("(?=)")
+        out.append(ch)
+        i += 1
+    out.append("(?=)")
+    return "".join(out)
+
+
+def _regex_children(op, av) -> list:
+    name = str(op)
+    if name == "SUBPATTERN":
+        return [av[-1]]
+    if name in ("ASSERT", "ASSERT_NOT"):
+        return [av[1]]
+    if name == "BRANCH":
+        return list(av[1])
+    if name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+        return [av[2]]
+    if name == "ATOMIC_GROUP":
+        return [av]
+    return []
+
+
+def _walk_regex(parsed):
+    for op, av in parsed:
+        yield op, av
+        for sub in _regex_children(op, av):
+            yield from _walk_regex(sub)
+
+
+def guard_regex(pattern: str, warnings: list[str]) -> str:
+    """
+    בדיקה מקדימה של regex מהמשתמש. ארוך מדי → ValueError;
+    לא תקין או מסוכן → מוחזר כטקסט מילולי (escaped) ונרשמת אזהרה.
+    """
+    if len(pattern) > REGEX_MAX_LENGTH:
+        raise ValueError(f"ביטוי החיפוש ארוך מדי ({len(pattern)} > {REGEX_MAX_LENGTH} תווים)")
+    try:
+        parsed = _sre_parser.parse(pattern)
+    except re.error:
+        risk = "ביטוי רגולרי לא תקין"
+    else:
+        try:
+            parsed = _sre_parser.parse(_mark_branches(pattern))
+        except re.error:
+            pass  # למשל (?#הערה) - הבדיקה רצה על הפירוש הרגיל
+        risk = _regex_risk(parsed)
+    if risk:
+        warnings.append(f"'{pattern}' טופל כטקסט מילולי: {risk}")
+        return re.escape(pattern)
+    return pattern
+
+
+def regex_filter(pattern: str, warnings: list[str]) -> dict:
+    return {"$regex": guard_regex(pattern, warnings), "$options": "i"}
+
+
+def explain_cost(col, query: dict) -> Optional[dict]:
+    """הערכת עלות לפי תוכנית השאילתה (queryPlanner בלבד - השאילתה לא מורצת)."""
+    try:
+        plan = col.database.command({
+            "explain": {"find": col.name, "filter": query},
+            "verbosity": "queryPlanner",
+        })
+    except Exception as e:
+        logger.debug(f"explain נכשל: {e}")
+        return None
+
+    stages = []
+    node = plan.get("queryPlanner", {}).get("winningPlan", {})
+    while isinstance(node, dict) and node:
+        node = node.get("queryPlan", node)
+        if "stage" in node:
+            stages.append(node["stage"])
+        node = node.get("inputStage")
+    collscan = "COLLSCAN" in stages
+    return {
+        "plan": " ← ".join(stages),
+        "collection_scan": collscan,
+        "estimated_docs_examined": col.estimated_document_count() if collscan else None,
+    }
+
+
+# ── חיפוש סמנטי מקומי (TF-IDF על features מגובבים) ─────────
+# כל snippet מיוצג כווקטור float32 באורך קבוע (hashing trick), מנורמל L2,
+# ונשמר בקובץ memmap על הדיסק. משקלי IDF נשמרים כמערך df נפרד ומוחלים על
+# השאילתה בלבד, כך שעדכון snippet בודד לא מחייב חישוב מחדש של כל המטריצה.
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[֐-׿]+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+_STOPWORDS = frozenset({
+    "the", "a", "an", "and", "or", "of", "to", "in", "is", "it", "for", "on",
+    "with", "as", "by", "be", "this", "that", "self", "return", "def", "var",
+    "let", "const", "function", "import", "from",
+})
+
+
+def _tokenize(text: str) -> list[str]:
+    """פירוק טקסט/קוד למילים: פיצול camelCase ו-snake_case, lowercase ו-stemming גס."""
+    tokens = []
+    for raw in _TOKEN_RE.findall(text or ""):
+        parts = _CAMEL_RE.findall(raw) if raw.isascii() else [raw]
+        for part in parts:
+            tok = part.lower()
+            if len(tok) > 4 and tok.endswith("s") and not tok.endswith("ss"):
+                tok = tok[:-1]
+            if len(tok) > 1 and tok not in _STOPWORDS:
+                tokens.append(tok)
+    return tokens
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+class _SemanticIndex:
+    """אינדקס וקטורי מקומי: מטריצה ממופה מהדיסק + מיפוי מזהה → שורה."""
+
+    GROW_BY = 4096
+
+    def __init__(self, path: str, dim: int, matrix_name: str = "vectors.f32", journal: bool = True):
+        self.path = path
+        self.dim = dim
+        self.matrix_name = matrix_name
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.grow_lock = threading.Lock()
+        self.loaded = False
+        self.dirty = False
+        self.ids: list[Optional[str]] = []
+        self.rows: dict[str, int] = {}
+        self.free: list[int] = []
+        self.df = None
+        self.n_docs = 0
+        self.capacity = 0
+        self.matrix = None
+        self.pending: Optional[dict[str, Optional[dict]]] = None
+        self.touched: Optional[set[int]] = None
+        self._log = None
+
+    # ── אחסון ──
+    # המטריצה נכתבת במקום (memmap). שיוך שורה → מזהה נרשם מיד ב-ids.log (append-only),
+    # ו-snapshot של ids ו-df נכתב רק ב-flush() - מטיימר ובכיבוי. אחרי עצירה לא מסודרת
+    # load() מחיל את היומן ומחשב את df מחדש מהמטריצה.
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _open_matrix(self, capacity: int):
+        # פריסה לפי עמודות (feature × מסמך): שאילתה קוראת רק את העמודות של המילים שבה
+        self.capacity = capacity
+        self.matrix = np.memmap(self._file(self.matrix_name), dtype=np.float32, mode="r+",
+                                shape=(self.dim, capacity))
+
+    def _ensure_capacity(self, rows: int):
+        if self.matrix is not None and rows <= self.capacity:
+            return
+        capacity = max(rows, self.capacity * 2, self.GROW_BY)
+        tmp = self._file(self.matrix_name + ".tmp")
+        grown = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(self.dim, capacity))
+        if self.matrix is not None:
+            grown[:, :self.capacity] = self.matrix
+        grown.flush()
+        del grown
+        self.matrix = None
+        os.replace(tmp, self._file(self.matrix_name))
+        self._open_matrix(capacity)
+
+    def _touch(self, row: int):
+        if self.touched is not None:
+            self.touched.add(row)
+        # אינדקס בנייה זמני (בלי יומן) גדל במקום - הוא כבר רץ ברקע
+        if self.journal and len(self.ids) * 5 > self.capacity * 4 and not self.grow_lock.locked():
+            threading.Thread(target=self.grow, name="semantic-index-grow", daemon=True).start()
+
+    def grow(self):
+        """
+        הגדלת המטריצה לפני שהיא מתמלאת, ב-thread רקע. ההעתקה רצה מחוץ לנעילת האינדקס;
+        שורות שנכתבו בזמן ההעתקה מועתקות שוב לפני ההחלפה.
+        """
+        with self.grow_lock:
+            with self.lock:
+                if not self.loaded or len(self.ids) * 5 <= self.capacity * 4:
+                    return
+                old, old_capacity = self.matrix, self.capacity
+                capacity = max(self.capacity * 2, self.GROW_BY)
+                self.touched = set()
+            tmp = self._file(self.matrix_name + ".grow")
+            try:
+                grown = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(self.dim, capacity))
+                grown[:, :old_capacity] = old
+            except BaseException:
+                with self.lock:
+                    self.touched = None
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp)
+                raise
+            with self.lock:
+                touched, self.touched = self.touched, None
+                if self.matrix is not old:
+                    # בינתיים הייתה בנייה מחדש או הגדלה סינכרונית - ההעתקה כבר לא רלוונטית
+                    del grown
+                    os.remove(tmp)
+                    return
+                if touched:
+                    cols = sorted(touched)
+                    grown[:, cols] = self.matrix[:, cols]
+                grown.flush()
+                del grown
+                self.matrix = None
+                os.replace(tmp, self._file(self.matrix_name))
+                self._open_matrix(capacity)
+
+    def _log_row(self, row: int, sid: Optional[str]):
+        self.dirty = True
+        if not self.journal:
+            return
+        if self._log is None:
+            self._log = open(self._file("ids.log"), "a")
+        # בלי fsync - היומן צריך לשרוד קריסת תהליך, כמו דפי ה-memmap
+        self._log.write(f"{row}\t{sid or ''}\n")
+        self._log.flush()
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _write_meta(self, ids: list, df, capacity: int):
+        np.save(self._file("df.npy"), df)
+        tmp = self._file("ids.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "capacity": capacity, "ids": ids}, f)
+        os.replace(tmp, self._file("ids.json"))
+
+    def flush(self):
+        """כתיבת snapshot של ids ו-df ואיפוס היומן. הכתיבה עצמה רצה מחוץ לנעילת האינדקס."""
+        with self.flush_lock:
+            with self.lock:
+                if not (self.loaded and self.dirty):
+                    return
+                self.matrix.flush()
+                ids, df, capacity = list(self.ids), self.df.copy(), self.capacity
+                # רשומות חדשות נכתבות מעכשיו ליומן חדש; הישן נמחק רק אחרי שה-snapshot על הדיסק
+                self._close_log()
+                if os.path.exists(self._file("ids.log")):
+                    os.replace(self._file("ids.log"), self._file("ids.log.1"))
+                self.dirty = False
+            self._write_meta(ids, df, capacity)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._file("ids.log.1"))
+
+    def _replay_log(self, ids: list) -> bool:
+        replayed = False
+        for name in ("ids.log.1", "ids.log"):
+            try:
+                with open(self._file(name)) as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                try:
+                    row_text, sid = line.rstrip("\n").split("\t")
+                    row = int(row_text)
+                except ValueError:
+                    continue  # שורה חלקית מקריסה באמצע כתיבה
+                ids.extend([None] * (row + 1 - len(ids)))
+                ids[row] = sid or None
+                replayed = True
+        return replayed
+
+    def load(self) -> bool:
+        """טעינת אינדקס קיים מהדיסק. מחזיר False אם אין אינדקס תואם."""
+        _import_numpy()
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(self._file("ids.json")) as f:
+                meta = json.load(f)
+            df = np.load(self._file("df.npy"))
+            capacity = os.path.getsize(self._file(self.matrix_name)) // (4 * self.dim)
+        except (OSError, ValueError):
+            return False
+        if meta.get("dim") != self.dim or df.shape != (self.dim,) or "capacity" not in meta:
+            return False
+        ids = meta["ids"]
+        replayed = self._replay_log(ids)
+        if len(ids) > capacity:
+            return False
+        self.ids = ids
+        self.rows = {sid: i for i, sid in enumerate(self.ids) if sid}
+        self.free = [i for i, sid in enumerate(self.ids) if not sid]
+        self.n_docs = len(self.rows)
+        self._open_matrix(capacity)
+        if replayed:
+            # df ב-snapshot ישן מהיומן - שורות בלי מזהה מתאפסות ו-df נספר מחדש מהמטריצה
+            if self.free:
+                self.matrix[:, self.free] = 0.0
+            df = (self.matrix[:, :len(self.ids)] > 0).sum(axis=1)
+            self.dirty = True
+        self.df = df.astype(np.float32)
+        self.loaded = True
+        return True
+
+    # ── וקטוריזציה ──
+
+    def _hash_counts(self, doc: dict) -> dict[int, float]:
+        # הכותרת נספרת פעמיים - היא המתארת הטובה ביותר של כוונת הקוד
+        title = doc.get("title") or ""
+        text = " ".join([
+            title,
+            title,
+            doc.get("description") or "",
+            " ".join(doc.get("tags") or []),
+            doc.get("code") or "",
+        ])
+        counts: dict[int, float] = {}
+        for tok in _tokenize(text):
+            h = zlib.crc32(tok.encode()) % self.dim
+            counts[h] = counts.get(h, 0.0) + 1.0
+        return counts
+
+    def _doc_vector(self, counts: dict[int, float]):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for h, c in counts.items():
+            vec[h] = 1.0 + np.log(c)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    def _query_vector(self, query: str):
+        counts = self._hash_counts({"title": query})
+        vec = np.zeros(self.dim, dtype=np.float32)
+        idf = np.log((1.0 + self.n_docs) / (1.0 + self.df)) + 1.0
+        for h, c in counts.items():
+            # idf² על צד השאילתה מקרב cosine של TF-IDF מלא בלי לשקלל מחדש את המסמכים
+            vec[h] = (1.0 + np.log(c)) * idf[h] * idf[h]
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    # ── עדכונים ──
+
+    def _put(self, sid: str, doc: dict):
+        counts = self._hash_counts(doc)
+        row = self.rows.get(sid)
+        if row is not None:
+            self.df[self.matrix[:, row] > 0] -= 1
+            self.dirty = True
+        else:
+            row = self.free.pop() if self.free else len(self.ids)
+            if row == len(self.ids):
+                self.ids.append(sid)
+            else:
+                self.ids[row] = sid
+            self.rows[sid] = row
+            self._ensure_capacity(row + 1)
+            self._log_row(row, sid)
+        vec = self._doc_vector(counts)
+        self.matrix[:, row] = vec
+        self.df[vec > 0] += 1
+        self.n_docs = len(self.rows)
+        self._touch(row)
+
+    def rebuild(self, col):
+        """
+        בנייה מלאה מהמאגר - מעבר יחיד עם cursor, לתוך קובץ מטריצה נפרד. האינדקס הקיים
+        ממשיך לשרת חיפושים בזמן הבנייה, וכתיבות שהגיעו בינתיים מוחלות שוב אחרי ההחלפה.
+        """
+        _import_numpy()
+        with self.rebuild_lock:
+            os.makedirs(self.path, exist_ok=True)
+            with self.lock:
+                self.pending = {}
+            fresh = _SemanticIndex(self.path, self.dim, matrix_name=self.matrix_name + ".rebuild", journal=False)
+            fresh.df = np.zeros(self.dim, dtype=np.float32)
+            try:
+                # מרווח מעל הספירה - כדי שה-snippet החדש הראשון לא יגרום להעתקת המטריצה
+                fresh._ensure_capacity(int(col.estimated_document_count() * 1.25) + self.GROW_BY)
+                projection = {"title": 1, "description": 1, "tags": 1, "code": 1, "code_codec": 1}
+                for doc in col.find({}, projection).batch_size(1000):
+                    fresh._put(str(doc["_id"]), unpack_code(doc))
+                fresh.matrix.flush()
+            except BaseException:
+                with self.lock:
+                    self.pending = None
+                raise
+
+            with self.flush_lock:
+                with self.lock:
+                    # ה-snapshot הישן נמחק לפני ההחלפה - קריסה עד שהחדש נכתב תוביל לבנייה מחדש
+                    self._close_log()
+                    for name in ("ids.json", "ids.log", "ids.log.1"):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(self._file(name))
+                    self.matrix = fresh.matrix = None
+                    os.replace(fresh._file(fresh.matrix_name), self._file(self.matrix_name))
+                    self.ids, self.rows, self.free = fresh.ids, fresh.rows, fresh.free
+                    self.df, self.n_docs = fresh.df, fresh.n_docs
+                    self._open_matrix(fresh.capacity)
+                    self.loaded, self.dirty = True, False
+                    ids, df, capacity = list(self.ids), self.df.copy(), self.capacity
+                    pending, self.pending = self.pending, None
+                self._write_meta(ids, df, capacity)
+
+            for sid, doc in pending.items():
+                if doc is None:
+                    self.remove(sid)
+                else:
+                    self.upsert(doc)
+
+    def ensure_loaded(self, col):
+        """טעינה מהדיסק או בנייה מהמאגר - פעם אחת גם כש-warm-up ובקשה מגיעים יחד."""
+        with self.load_lock:
+            if self.loaded:
+                return
+            if not self.load():
+                self.rebuild(col)
+
+    def rebuild_in_background(self, col) -> str:
+        """בנייה מחדש ב-thread רקע. מחזיר "started", או "running" אם בנייה כבר רצה."""
+        if self.rebuild_lock.locked():
+            return "running"
+
+        def run():
+            try:
+                self.rebuild(col)
+            except Exception as e:
+                logger.warning(f"בנייה מחדש של האינדקס הסמנטי נכשלה: {e}")
+
+        threading.Thread(target=run, name="semantic-index-rebuild", daemon=True).start()
+        return "started"
+
+    def upsert(self, doc: dict):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[str(doc["_id"])] = doc
+            if not self.loaded:
+                return
+            self._put(str(doc["_id"]), doc)
+
+    def remove(self, snippet_id: str):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[snippet_id] = None
+            if not self.loaded:
+                return
+            row = self.rows.pop(snippet_id, None)
+            if row is None:
+                return
+            self.df[self.matrix[:, row] > 0] -= 1
+            self.matrix[:, row] = 0.0
+            self.ids[row] = None
+            self.free.append(row)
+            self.n_docs = len(self.rows)
+            self._log_row(row, None)
+            self._touch(row)
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        with self.lock:
+            size = len(self.ids)
+            if not size:
+                return []
+            q = self._query_vector(query)
+            nz = np.flatnonzero(q)
+            if not nz.size:
+                return []
+            # רק העמודות שמופיעות בשאילתה משתתפות במכפלה
+            scores = q[nz] @ self.matrix[nz, :size]
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[i], float(scores[i])) for i in top if scores[i] > 0 and self.ids[i]]
+
+
+_semantic_index = _SemanticIndex(SEMANTIC_INDEX_DIR, SEMANTIC_DIM)
+
+
+_index_slot_fd: Optional[int] = None
+
+
+def claim_index_slot(workers: int) -> str:
+    """
+    בריבוי workers כל תהליך מקבל תיקיית אינדקס משלו (worker-N), נעולה ב-flock
+    כך ששני תהליכים לא כותבים לאותו memmap. התיקייה נשמרת בין ריסטארטים.
+    """
+    import fcntl
+
+    global _index_slot_fd
+    for slot in range(workers * 2):
+        path = os.path.join(SEMANTIC_INDEX_DIR, f"worker-{slot}")
+        os.makedirs(path, exist_ok=True)
+        fd = os.open(os.path.join(path, ".lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        _index_slot_fd = fd
+        _semantic_index.path = path
+        return path
+    raise RuntimeError("לא נמצאה תיקיית אינדקס פנויה ל-worker")
+
+
+_flusher_pid: Optional[int] = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_semantic_index_loop():
+    while True:
+        time.sleep(SEMANTIC_FLUSH_SECONDS)
+        try:
+            _semantic_index.flush()
+        except OSError as e:
+            logger.warning(f"שמירת האינדקס הסמנטי נכשלה: {e}")
+
+
+def start_index_flusher():
+    """thread שכותב snapshot של האינדקס הסמנטי כל SEMANTIC_FLUSH_SECONDS, פעם אחת לכל תהליך."""
+    global _flusher_pid
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_semantic_index_loop, name="semantic-index-flush", daemon=True).start()
+
+
+def get_semantic_index() -> _SemanticIndex:
+    """טעינת האינדקס מהדיסק, או בנייה מהמאגר בהפעלה ראשונה."""
+    _semantic_index.ensure_loaded(get_collection())
+    start_index_flusher()
+    start_change_stream()
+    return _semantic_index
+
+
+def load_semantic_index_in_background() -> str:
+    """get_semantic_index ב-thread רקע. מחזיר "started", או "running" אם טעינה כבר רצה."""
+    if _semantic_index.load_lock.locked():
+        return "running"
+
+    def run():
+        try:
+            get_semantic_index()
+        except Exception as e:
+            logger.warning(f"טעינת האינדקס הסמנטי נכשלה: {e}")
+
+    threading.Thread(target=run, name="semantic-index-load", daemon=True).start()
+    return "started"
+
+
+# ── אינדקס facets (תגיות ושפות) ─────────────────────────────
+# מילון של כל ערכי tags ו-language עם ספירות, לכל worker. כל facet נשמר כמערך
+# ממוין של (casefold, ערך) - השלמת prefix היא bisect ומעבר על הטווח התואם.
+# לכל snippet נשמר רק מזהה של חתימת (שפה, תגיות), וחתימות זהות משותפות, כך
+# שעדכון או מחיקה (גם מה-change stream) מפחיתים בדיוק את מה שנספר - העדכון
+# אידמפוטנטי כמו באינדקס הסמנטי.
+
+FACETS = ("tags", "language")
+
+
+class _FacetIndex:
+    _STATE = ("snippets", "signatures", "signature_ids", "signature_refs", "free_signatures", "counts", "sorted")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.built_at = 0.0
+        self.generation = 0
+        self.pending: Optional[dict[str, Optional[dict]]] = None
+        self._reset()
+
+    def _reset(self):
+        self.snippets: dict[str, int] = {}
+        self.signatures: list[Optional[tuple[str, tuple[str, ...]]]] = []
+        self.signature_ids: dict[tuple[str, tuple[str, ...]], int] = {}
+        self.signature_refs: list[int] = []
+        self.free_signatures: list[int] = []
+        self.counts: dict[str, dict[str, int]] = {f: {} for f in FACETS}
+        self.sorted: dict[str, list[tuple[str, str]]] = {f: [] for f in FACETS}
+
+    def _signature(self, doc: dict) -> int:
+        tags = doc.get("tags") or []
+        key = (doc.get("language") or "", tuple(sorted({t for t in tags if isinstance(t, str) and t})))
+        sig = self.signature_ids.get(key)
+        if sig is None:
+            if self.free_signatures:
+                sig = self.free_signatures.pop()
+                self.signatures[sig], self.signature_refs[sig] = key, 0
+            else:
+                sig = len(self.signatures)
+                self.signatures.append(key)
+                self.signature_refs.append(0)
+            self.signature_ids[key] = sig
+        return sig
+
+    def _release(self, sig: int):
+        # חתימה שאף snippet לא משתמש בה יותר מתפנה לשימוש חוזר
+        self._apply(sig, -1)
+        self.signature_refs[sig] -= 1
+        if not self.signature_refs[sig]:
+            del self.signature_ids[self.signatures[sig]]
+            self.signatures[sig] = None
+            self.free_signatures.append(sig)
+
+    def _bump(self, facet: str, value: str, delta: int):
+        counts = self.counts[facet]
+        count = counts.get(value, 0) + delta
+        entry = (value.casefold(), value)
+        if count > 0:
+            if value not in counts:
+                bisect.insort(self.sorted[facet], entry)
+            counts[value] = count
+        elif value in counts:
+            del counts[value]
+            keys = self.sorted[facet]
+            del keys[bisect.bisect_left(keys, entry)]
+
+    def _apply(self, sig: int, delta: int):
+        language, tags = self.signatures[sig]
+        if language:
+            self._bump("language", language, delta)
+        for tag in tags:
+            self._bump("tags", tag, delta)
+
+    def _put(self, snippet_id: str, doc: dict):
+        sig = self._signature(doc)
+        old = self.snippets.get(snippet_id)
+        if old == sig:
+            return
+        self.snippets[snippet_id] = sig
+        self.signature_refs[sig] += 1
+        self._apply(sig, +1)
+        if old is not None:
+            self._release(old)
+
+    def _remove(self, snippet_id: str):
+        sig = self.snippets.pop(snippet_id, None)
+        if sig is not None:
+            self._release(sig)
+
+    def rebuild(self, col):
+        """
+        בנייה מלאה - מעבר אחד על language ו-tags, לתוך מבנים חדשים מחוץ לנעילה. האינדקס
+        הקיים ממשיך לענות בזמן הבנייה, וכתיבות שהגיעו בינתיים מוחלות שוב לפני ההחלפה.
+        """
+        with self.rebuild_lock:
+            with self.lock:
+                self.pending = {}
+                generation = self.generation
+            fresh = _FacetIndex()
+            try:
+                for doc in col.find({}, {"language": 1, "tags": 1}).batch_size(5000):
+                    fresh._put(str(doc["_id"]), doc)
+            except BaseException:
+                with self.lock:
+                    self.pending = None
+                raise
+            with self.lock:
+                for sid, doc in self.pending.items():
+                    if doc is None:
+                        fresh._remove(sid)
+                    else:
+                        fresh._put(sid, doc)
+                self.pending = None
+                for name in self._STATE:
+                    setattr(self, name, getattr(fresh, name))
+                # invalidate() בזמן הבנייה - ייתכן שהסריקה פספסה את השינוי
+                self.loaded = self.generation == generation
+                self.built_at = time.monotonic()
+
+    def ensure_loaded(self, col):
+        """בנייה בשימוש הראשון - פעם אחת גם כשכמה בקשות מגיעות יחד."""
+        with self.load_lock:
+            if not self.loaded:
+                self.rebuild(col)
+
+    def upsert(self, doc: dict):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[str(doc["_id"])] = {"language": doc.get("language"), "tags": doc.get("tags")}
+            if self.loaded:
+                self._put(str(doc["_id"]), doc)
+
+    def remove(self, snippet_id: str):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[snippet_id] = None
+            if self.loaded:
+                self._remove(snippet_id)
+
+    def invalidate(self):
+        """סימון לבנייה מחדש בשימוש הבא - כשהשינוי לא מגיע לפי מסמך."""
+        with self.lock:
+            self.loaded = False
+            self.generation += 1
+
+    def suggest(self, facet: str, prefix: str, limit: int) -> tuple[int, list[tuple[str, int]]]:
+        """(מספר הערכים התואמים, הערכים הנפוצים ביותר עם prefix - לפי ספירה)."""
+        with self.lock:
+            keys, counts = self.sorted[facet], self.counts[facet]
+            folded = prefix.casefold()
+            start = bisect.bisect_left(keys, (folded,))
+            end = bisect.bisect_left(keys, (folded + "\U0010ffff",)) if folded else len(keys)
+            matches = [(value, counts[value]) for _, value in keys[start:end]]
+        return len(matches), heapq.nlargest(limit, matches, key=lambda m: m[1])
+
+
+_facet_index = _FacetIndex()
+
+
+def get_facet_index() -> _FacetIndex:
+    """
+    בלי change stream כתיבות מתהליכים אחרים (הבוט, workers אחרים) לא מגיעות לאינדקס,
+    לכן אחרי CACHE_TTL_SECONDS הוא נבנה מחדש ברקע והאינדקס הקיים ממשיך לענות.
+    """
+    _facet_index.ensure_loaded(get_collection())
+    expired = time.monotonic() - _facet_index.built_at > CACHE_TTL_SECONDS
+    if _cache_mode != "change_stream" and expired and not _facet_index.rebuild_lock.locked():
+        threading.Thread(target=_refresh_facet_index, name="facet-index-refresh", daemon=True).start()
+    return _facet_index
+
+
+def _refresh_facet_index():
+    try:
+        _facet_index.rebuild(get_collection())
+    except PyMongoError as e:
+        logger.warning(f"רענון אינדקס ה-facets נכשל: {e}")
+
+
+def ensure_facet_indexes(col):
+    """אינדקסים לסינון מדויק לפי tag / language עם המיון של list_snippets."""
+    for field in FACETS:
+        try:
+            col.create_index([(field, 1), ("created_at", -1)])
+        except PyMongoError as e:
+            logger.warning(f"יצירת אינדקס על {field} נכשלה: {e}")
+
+
+# ── קוהרנטיות cache בין workers ──────────────────────────
+# כל worker מחזיק caches ואינדקסים נגזרים משלו (סטטיסטיקות, ניתוח, חיפוש סמנטי).
+# thread רקע מאזין ל-change stream של האוסף - כולל כתיבות של כלים חיצוניים כמו
+# בוט הטלגרם - ומעדכן אותם לפי מזהה מסמך. ה-resume token נשמר לצד האינדקס
+# הסמנטי כדי שהשניים יישארו עקביים אחרי ריסטארט. כש-change streams לא זמינים
+# (mongod בודד), ה-caches נשענים על TTL בלבד והאינדקס הסמנטי נבנה מחדש מדי פעם.
+
+_stats_cache: dict = {}
+_analysis_cache: dict[str, tuple[float, dict]] = {}
+_cache_mode = "ttl"
+
+
+def cache_get(cache: dict, key: str):
+    entry = cache.get(key)
+    if entry and time.monotonic() - entry[0] < CACHE_TTL_SECONDS:
+        return entry[1]
+    return None
+
+
+def cache_put(cache: dict, key: str, value):
+    cache[key] = (time.monotonic(), value)
+
+
+def invalidate_snippet(snippet_id: str, doc: Optional[dict] = None, deleted: bool = False):
+    """ביטול caches ועדכון אינדקסים נגזרים עבור snippet שהשתנה."""
+    _stats_cache.clear()
+    _analysis_cache.pop(snippet_id, None)
+    if deleted:
+        _semantic_index.remove(snippet_id)
+        _facet_index.remove(snippet_id)
+    elif doc is not None:
+        _semantic_index.upsert(unpack_code(doc))
+        _facet_index.upsert({**doc, "_id": snippet_id})
+
+
+def invalidate_all():
+    _stats_cache.clear()
+    _analysis_cache.clear()
+
+
+def _resume_token_path() -> str:
+    return os.path.join(_semantic_index.path, "change_stream_token.json")
+
+
+def _load_resume_token() -> Optional[dict]:
+    try:
+        with open(_resume_token_path()) as f:
+            return json_util.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _save_resume_token(token: Optional[dict]):
+    os.makedirs(_semantic_index.path, exist_ok=True)
+    tmp = _resume_token_path() + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(json_util.dumps(token))
+    os.replace(tmp, _resume_token_path())
+
+
+_STREAM_INVALIDATING = ("drop", "rename", "dropDatabase", "invalidate")
+
+
+def _apply_change(change: dict):
+    op = change["operationType"]
+    if op in ("insert", "update", "replace"):
+        snippet_id = str(change["documentKey"]["_id"])
+        doc = change.get("fullDocument")
+        invalidate_snippet(snippet_id, doc, deleted=doc is None)
+    elif op == "delete":
+        invalidate_snippet(str(change["documentKey"]["_id"]), deleted=True)
+    else:
+        # drop / rename / invalidate - אין דרך לעדכן לפי מזהה
+        invalidate_all()
+        if _semantic_index.loaded:
+            _semantic_index.rebuild(get_collection())
+        if _facet_index.loaded:
+            _facet_index.rebuild(get_collection())
+
+
+_watcher_pid: Optional[int] = None
+_watcher_lock = threading.Lock()
+
+
+def start_change_stream():
+    """
+    הפעלת thread ה-change stream, פעם אחת לכל תהליך.
+    נקרא רק אחרי שהאינדקס הסמנטי נטען או נבנה: ה-stream ממשיך מה-token השמור ומחיל
+    את השינויים שנצברו בזמן שה-worker היה למטה, והם צריכים אינדקס טעון כדי לא ללכת לאיבוד.
+    """
+    global _watcher_pid
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+    if not CACHE_CHANGE_STREAM:
+        # בלי stream האינדקסים מתרעננים מחזורית
+        threading.Thread(target=refresh_indexes_loop, args=(get_collection(),),
+                         name="index-refresh", daemon=True).start()
+        return
+    threading.Thread(target=watch_changes, args=(get_collection(),),
+                     name="cache-change-stream", daemon=True).start()
+
+
+def watch_changes(col):
+    """לולאת ה-change stream. רצה ב-thread רקע לכל worker."""
+    global _cache_mode
+    token = _load_resume_token()
+    while True:
+        invalidated = False
+        try:
+            with col.watch(full_document="updateLookup", resume_after=token) as stream:
+                _cache_mode = "change_stream"
+                logger.info("change stream פעיל - caches מסונכרנים לפי מזהה מסמך")
+                for change in stream:
+                    try:
+                        _apply_change(change)
+                    except Exception as e:
+                        # שינוי שלא הוחל (למשל קוד zstd בלי החבילה) - לא עוצר את ה-stream
+                        logger.warning(f"החלת שינוי מה-change stream נכשלה: {e}")
+                        invalidate_all()
+                    if change["operationType"] in _STREAM_INVALIDATING:
+                        # אי אפשר להמשיך מ-token של אירוע invalidate - ה-stream נפתח מחדש מהנקודה הנוכחית
+                        token = None
+                        _save_resume_token(None)
+                        invalidated = True
+                        break
+                    token = stream.resume_token
+                    if _semantic_index.loaded:
+                        # בלי אינדקס טעון השינוי לא נרשם בו - ה-token נשאר במקום ויוחל שוב בהפעלה הבאה
+                        _save_resume_token(token)
+            if invalidated:
+                continue
+        except OperationFailure as e:
+            if e.code in _CHANGE_STREAM_HISTORY_LOST:
+                # ה-token ישן מדי - בנייה מלאה והתחלה מחדש מהנקודה הנוכחית
+                logger.warning("resume token פג תוקף - בונה caches מחדש")
+                token = None
+                invalidate_all()
+                if _semantic_index.loaded:
+                    _semantic_index.rebuild(col)
+                if _facet_index.loaded:
+                    _facet_index.rebuild(col)
+                continue
+            if e.code in _CHANGE_STREAM_UNSUPPORTED:
+                break
+            logger.warning(f"change stream נכשל: {e}")
+        except PyMongoError as e:
+            logger.warning(f"change stream נותק: {e}")
+        except Exception as e:
+            # למשל OSError בשמירת ה-token - ה-thread ממשיך, וה-caches חוזרים ל-TTL עד החיבור הבא
+            logger.warning(f"change stream נעצר: {e}")
+        _cache_mode = "ttl"
+        time.sleep(5)
+
+    _cache_mode = "ttl"
+    logger.info("change streams לא זמינים - caches עובדים לפי TTL בלבד")
+    refresh_indexes_loop(col)
+
+
+def refresh_indexes_loop(col):
+    """בלי change stream: בנייה מחדש של האינדקסים כל SEMANTIC_REFRESH_SECONDS."""
+    while True:
+        time.sleep(SEMANTIC_REFRESH_SECONDS)
+        if _semantic_index.loaded:
+            try:
+                _semantic_index.rebuild(col)
+            except Exception as e:
+                logger.warning(f"רענון אינדקס סמנטי נכשל: {e}")
+        if _facet_index.loaded:
+            try:
+                _facet_index.rebuild(col)
+            except Exception as e:
+                logger.warning(f"רענון אינדקס facets נכשל: {e}")
+
+
 # ── HTTP Helpers ────────────────────────────────────────────
 
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """AsyncClient משותף ל-worker - connection pool ו-keep-alive מול Render ו-GitHub."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=15,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2),
+            event_hooks={"request": [_http_span_start], "response": [_http_span_end]},
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 def render_headers() -> dict:
     return {
         "Authorization": f"Bearer {RENDER_API_KEY}",
@@ -74,22 +1972,30 @@ def render_headers() -> dict:
     }
 
 
+_render_owner_id: Optional[str] = None
+
+
 async def _resolve_render_owner() -> Optional[str]:
-    """שליפת מזהה הבעלים מ-Render API אם לא הוגדר כמשתנה סביבה."""
+    """שליפת מזהה הבעלים מ-Render API אם לא הוגדר כמשתנה סביבה (נשמר לאחר השליפה הראשונה)."""
+    global _render_owner_id
     if RENDER_OWNER_ID:
         return RENDER_OWNER_ID
+    if _render_owner_id:
+        return _render_owner_id
     if not RENDER_API_KEY:
         return None
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.get(
-            f"{RENDER_API_BASE}/owners",
-            headers=render_headers(),
-        )
-        if resp.status_code == 200:
-            owners = resp.json()
-            if owners and isinstance(owners, list) and len(owners) > 0:
-                owner = owners[0].get("owner", {})
-                return owner.get("id")
+    client = get_http_client()
+    resp = await client.get(
+        f"{RENDER_API_BASE}/owners",
+        headers=render_headers(),
+        timeout=15,
+    )
+    if resp.status_code == 200:
+        owners = resp.json()
+        if owners and isinstance(owners, list) and len(owners) > 0:
+            owner = owners[0].get("owner", {})
+            _render_owner_id = owner.get("id")
+            return _render_owner_id
     return None
 
 
@@ -117,17 +2023,43 @@ mcp = FastMCP(
     ),
 )
 
+_skipped_tools: list[str] = []
+
+
+def integration_tool(configured: bool):
+    """
+    @mcp.tool() לכלי אינטגרציה: כשהאינטגרציה לא מוגדרת הכלי לא נרשם - רשימת
+    הכלים של הלקוח נשארת נקייה, ועלות בניית הסכמה שלו נחסכת בעליית התהליך.
+    """
+    if configured:
+        return mcp.tool()
+
+    def skip(func):
+        _skipped_tools.append(func.__name__)
+        return func
+
+    return skip
+
+
+def integration_prompt(configured: bool):
+    """@mcp.prompt() לפרומפט שמנחה להפעיל כלי אינטגרציה - לא נרשם כשהכלים שלו לא נרשמו."""
+    return mcp.prompt() if configured else (lambda func: func)
+
 
 # ┌─────────────────────────────────────────────────────────┐
 # │  1. כלי Snippets - ניהול קוד                            │
 # └─────────────────────────────────────────────────────────┘
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def list_snippets(
     language: Optional[str] = None,
     tag: Optional[str] = None,
     limit: int = 20,
     search: Optional[str] = None,
+    exact: bool = False,
 ) -> dict:
     """
     רשימת snippets מהמאגר.
@@ -138,40 +2070,78 @@ def list_snippets(
         tag: סינון לפי תגית
         limit: מספר תוצאות מקסימלי (ברירת מחדל: 20)
         search: חיפוש טקסט חופשי בכותרת ובתוכן
+        exact: language ו-tag כערכים מדויקים (למשל מ-suggest_facets) - שאילתה על אינדקס במקום regex
     """
     col = get_collection()
-    query = {}
-    if language:
-        query["language"] = {"$regex": language, "$options": "i"}
-    if tag:
-        query["tags"] = {"$regex": tag, "$options": "i"}
-    if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"code": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-        ]
+    warnings: list[str] = []
+    try:
+        query = {}
+        if language:
+            query["language"] = language if exact else regex_filter(language, warnings)
+        if tag:
+            query["tags"] = tag if exact else regex_filter(tag, warnings)
+        if search:
+            query["$or"] = code_search_clause(col, guard_regex(search, warnings),
+                                              ("title", "code", "description"), dict(query), warnings)
+    except ValueError as e:
+        return {"error": str(e)}
     docs = list(col.find(query).sort("created_at", -1).limit(limit))
-    return {"count": len(docs), "snippets": [serialize_doc(d) for d in docs]}
+    result = {"count": len(docs), "snippets": serialize_docs(docs)}
+    if query:
+        result["cost"] = explain_cost(col, query)
+    if warnings:
+        result["regex_warnings"] = warnings
+    return result
+
+
+def _slice_lines(code: str, start_line: int, max_lines: int) -> tuple[str, dict]:
+    """
+    חיתוך טווח שורות מגוף הקוד, לקריאה בחלקים של snippet שחורג מתקציב התשובה.
+
+    Args:
+        code: גוף הקוד המלא
+        start_line: שורה ראשונה (1 = תחילת הקובץ)
+        max_lines: מספר שורות מקסימלי (0 = עד הסוף)
+    """
+    lines = code.split("\n")
+    start = max(1, start_line)
+    end = len(lines) if max_lines <= 0 else min(len(lines), start + max_lines - 1)
+    info = {"start_line": start, "end_line": end, "total_lines": len(lines)}
+    if end < len(lines):
+        info["next_start_line"] = end + 1
+    return "\n".join(lines[start - 1:end]), info
 
 
 @mcp.tool()
-def get_snippet(snippet_id: str) -> dict:
+@profiled
+@with_response_budget
+@with_time_budget
+def get_snippet(snippet_id: str, start_line: int = 1, max_lines: int = 0) -> dict:
     """
     קבלת snippet בודד לפי מזהה.
+    גוף גדול מהתקציב נקרא בחלקים עם start_line/max_lines (ההמשך ב-lines.next_start_line).
 
     Args:
         snippet_id: מזהה ה-snippet (MongoDB ObjectId)
+        start_line: שורה ראשונה של הקוד להחזרה (ברירת מחדל: 1)
+        max_lines: מספר שורות מקסימלי (ברירת מחדל: 0 = כל הקוד)
     """
     col = get_collection()
     doc = col.find_one({"_id": ObjectId(snippet_id)})
     if not doc:
         return {"error": f"snippet עם מזהה {snippet_id} לא נמצא"}
-    return {"snippet": serialize_doc(doc)}
+    snippet = serialize_doc(doc)
+    if start_line > 1 or max_lines > 0:
+        snippet["code"], lines = _slice_lines(snippet.get("code", ""), start_line, max_lines)
+        return {"snippet": snippet, "lines": lines}
+    return {"snippet": snippet}
 
 
 @mcp.tool()
-def create_snippet(
+@profiled
+@with_response_budget
+@with_time_budget
+async def create_snippet(
     title: str,
     code: str,
     language: str = "python",
@@ -180,6 +2150,7 @@ def create_snippet(
 ) -> dict:
     """
     יצירת snippet חדש במאגר.
+    עם WRITE_COALESCE, קריאות מקבילות נכתבות יחד ב-insert_many אחד.
 
     Args:
         title: כותרת ה-snippet
@@ -188,11 +2159,12 @@ def create_snippet(
         description: תיאור אופציונלי
         tags: רשימת תגיות אופציונלית
     """
-    col = get_collection()
     now = datetime.now(timezone.utc)
+    code_fields, _ = pack_code(code)
     doc = {
+        "_id": ObjectId(),
         "title": title,
-        "code": code,
+        **code_fields,
         "language": language,
         "description": description,
         "tags": tags or [],
@@ -200,12 +2172,22 @@ def create_snippet(
         "updated_at": now,
         "source": "mcp",
     }
-    result = col.insert_one(doc)
-    doc["_id"] = str(result.inserted_id)
+    if WRITE_COALESCE:
+        inserted_id = await get_insert_batcher().insert(doc)
+    else:
+        inserted_id = get_write_collection().insert_one(doc).inserted_id
+    for f in _CODE_CODEC_FIELDS:
+        doc.pop(f, None)
+    doc["code"] = code
+    invalidate_snippet(str(inserted_id), doc)
+    doc["_id"] = str(inserted_id)
     return {"message": "snippet נוצר בהצלחה", "snippet": serialize_doc(doc)}
 
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def update_snippet(
     snippet_id: str,
     title: Optional[str] = None,
@@ -227,20 +2209,48 @@ def update_snippet(
     """
     col = get_collection()
     updates = {"updated_at": datetime.now(timezone.utc)}
-    for key, val in [("title", title), ("code", code), ("language", language),
+    for key, val in [("title", title), ("language", language),
                      ("description", description), ("tags", tags)]:
         if val is not None:
             updates[key] = val
-
-    result = col.update_one({"_id": ObjectId(snippet_id)}, {"$set": updates})
+    operations = {"$set": updates}
+    match = {"_id": ObjectId(snippet_id)}
+    if code is not None:
+        current = unpack_code(col.find_one(match, {"code": 1, "code_codec": 1, "version": 1}))
+        if not current:
+            return {"error": f"snippet {snippet_id} לא נמצא"}
+        old_code = current.get("code") or ""
+        if code != old_code:
+            version = current.get("version", 1)
+            updates["version"] = version + 1
+            # התנאי על version מונע דילוג על גרסה כשני עדכונים רצים במקביל
+            match["version"] = current["version"] if "version" in current else {"$exists": False}
+        code_fields, unset_fields = pack_code(code)
+        updates.update(code_fields)
+        if unset_fields:
+            operations["$unset"] = unset_fields
+
+    result = col.update_one(match, operations)
     if result.matched_count == 0:
+        if "version" in match:
+            return {"error": f"snippet {snippet_id} עודכן במקביל - נסה שוב"}
         return {"error": f"snippet {snippet_id} לא נמצא"}
-
-    updated = col.find_one({"_id": ObjectId(snippet_id)})
+    if "version" in match:
+        # ההיסטוריה נכתבת רק ע"י העדכון שזכה בגרסה - עדכון מקביל שהפסיד לא משאיר רשומה
+        if "version" not in current:
+            # snippet מלפני ההיסטוריה - הגרסה הקודמת נשמרת כ-snapshot ראשון
+            record_version(match["_id"], 1, "", old_code)
+        record_version(match["_id"], updates["version"], old_code, code)
+
+    updated = unpack_code(col.find_one({"_id": ObjectId(snippet_id)}))
+    invalidate_snippet(snippet_id, updated)
     return {"message": "snippet עודכן", "snippet": serialize_doc(updated)}
 
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def delete_snippet(snippet_id: str) -> dict:
     """
     מחיקת snippet מהמאגר.
@@ -249,52 +2259,300 @@ def delete_snippet(snippet_id: str) -> dict:
         snippet_id: מזהה ה-snippet למחיקה
     """
     col = get_collection()
-    doc = col.find_one({"_id": ObjectId(snippet_id)})
+    doc = col.find_one({"_id": ObjectId(snippet_id)}, {"title": 1})
     if not doc:
         return {"error": f"snippet {snippet_id} לא נמצא"}
     col.delete_one({"_id": ObjectId(snippet_id)})
+    get_versions_collection().delete_many({"snippet_id": ObjectId(snippet_id)})
+    invalidate_snippet(snippet_id, deleted=True)
     return {"message": f"snippet '{doc.get('title', '')}' נמחק"}
 
 
 @mcp.tool()
-def search_by_code(pattern: str, language: Optional[str] = None) -> dict:
+@profiled
+@with_response_budget
+@with_time_budget
+def list_snippet_versions(snippet_id: str, limit: int = 20) -> dict:
+    """
+    רשימת הגרסאות השמורות של snippet (ללא תוכן הקוד).
+
+    Args:
+        snippet_id: מזהה ה-snippet
+        limit: מספר גרסאות מקסימלי, מהחדשה לישנה (ברירת מחדל: 20)
+    """
+    col = get_collection()
+    doc = col.find_one({"_id": ObjectId(snippet_id)}, {"title": 1, "version": 1})
+    if not doc:
+        return {"error": f"snippet {snippet_id} לא נמצא"}
+
+    projection = {"version": 1, "kind": 1, "created_at": 1}
+    versions = []
+    for v in get_versions_collection().find({"snippet_id": doc["_id"]}, projection).sort("version", -1).limit(limit):
+        ca = v.get("created_at")
+        versions.append({
+            "version": v["version"],
+            "kind": v["kind"],
+            "created_at": ca.isoformat() if isinstance(ca, datetime) else ca,
+        })
+    return {
+        "snippet_id": snippet_id,
+        "title": doc.get("title", ""),
+        "current_version": doc.get("version", 1),
+        "count": len(versions),
+        "versions": versions,
+    }
+
+
+@mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
+def get_snippet_version(snippet_id: str, version: int, start_line: int = 1, max_lines: int = 0) -> dict:
+    """
+    קבלת הקוד של גרסה מסוימת של snippet.
+
+    Args:
+        snippet_id: מזהה ה-snippet
+        version: מספר הגרסה (מ-list_snippet_versions)
+        start_line: שורה ראשונה של הקוד להחזרה (ברירת מחדל: 1)
+        max_lines: מספר שורות מקסימלי (ברירת מחדל: 0 = כל הקוד)
+    """
+    col = get_collection()
+    doc = col.find_one({"_id": ObjectId(snippet_id)}, {"version": 1})
+    if not doc:
+        return {"error": f"snippet {snippet_id} לא נמצא"}
+
+    current = doc.get("version", 1)
+    if version == current:
+        code = unpack_code(col.find_one({"_id": doc["_id"]}, {"code": 1, "code_codec": 1}))["code"]
+    elif 1 <= version < current:
+        code = reconstruct_version(doc["_id"], version)
+        if code is None:
+            return {"error": f"שרשרת הגרסאות של {snippet_id} חסרה עבור גרסה {version}"}
+    else:
+        return {"error": f"גרסה {version} לא קיימת (גרסה נוכחית: {current})"}
+
+    result = {"snippet_id": snippet_id, "version": version, "current_version": current, "code": code}
+    if start_line > 1 or max_lines > 0:
+        result["code"], result["lines"] = _slice_lines(code, start_line, max_lines)
+    return result
+
+
+def _match_blocks(regex, code: str, context: int) -> tuple[int, list[dict]]:
+    """
+    מעבר יחיד של regex על הקוד. מחזיר מספר התאמות ובלוקים של שורות עם הקשר,
+    כשחלונות חופפים מאוחדים לבלוק אחד.
+    """
+    line_starts = [0]
+    line_starts.extend(m.end() for m in re.finditer("\n", code))
+    lines = code.split("\n")
+
+    match_count = 0
+    match_lines: list[int] = []
+    for m in bounded_finditer(regex, code):
+        match_count += 1
+        line_no = bisect.bisect_right(line_starts, m.start())
+        if not match_lines or match_lines[-1] != line_no:
+            match_lines.append(line_no)
+
+    blocks: list[dict] = []
+    for line_no in match_lines:
+        start = max(1, line_no - context)
+        end = min(len(lines), line_no + context)
+        if blocks and start <= blocks[-1]["end_line"] + 1:
+            blocks[-1]["end_line"] = end
+            blocks[-1]["match_lines"].append(line_no)
+        else:
+            blocks.append({"start_line": start, "end_line": end, "match_lines": [line_no]})
+    for block in blocks:
+        block["text"] = "\n".join(lines[block["start_line"] - 1:block["end_line"]])
+    return match_count, blocks
+
+
+@mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
+def search_by_code(
+    pattern: str,
+    language: Optional[str] = None,
+    context_lines: Optional[int] = None,
+    max_bytes: int = 20000,
+) -> dict:
     """
     חיפוש בתוך הקוד עצמו לפי ביטוי רגולרי או טקסט.
+    כש-context_lines מוגדר, מוחזרות רק שורות ההתאמה עם הקשר במקום המסמכים המלאים.
 
     Args:
         pattern: טקסט או regex לחיפוש בקוד
         language: סינון אופציונלי לפי שפה
+        context_lines: מספר שורות הקשר סביב כל התאמה (אופציונלי, מפעיל מצב הקשר)
+        max_bytes: תקציב בתים כולל לתוצאות במצב הקשר (ברירת מחדל: 20000)
+    """
+    col = get_collection()
+    warnings: list[str] = []
+    try:
+        safe_pattern = guard_regex(pattern, warnings)
+        query = {}
+        if language:
+            query["language"] = regex_filter(language, warnings)
+        query["$or"] = code_search_clause(col, safe_pattern, ("code",), dict(query), warnings)
+    except ValueError as e:
+        return {"error": str(e)}
+    extra = {"cost": explain_cost(col, query)}
+    if warnings:
+        extra["regex_warnings"] = warnings
+
+    if context_lines is None:
+        docs = list(col.find(query).sort("created_at", -1).limit(20))
+        return {"count": len(docs), "pattern": pattern, "snippets": serialize_docs(docs), **extra}
+
+    regex = compile_code_regex(safe_pattern)
+    context_lines = max(0, min(context_lines, 20))
+
+    results = []
+    total_matches = 0
+    used_bytes = 0
+    truncated = False
+    projection = {"title": 1, "language": 1, "code": 1, "code_codec": 1}
+    for doc in col.find(query, projection).sort("created_at", -1):
+        unpack_code(doc)
+        try:
+            with span("analysis"):
+                match_count, blocks = _match_blocks(regex, doc.get("code") or "", context_lines)
+        except TimeoutError:
+            warnings.append(f"ההתאמה ל-snippet {doc['_id']} נעצרה אחרי {REGEX_SCAN_TIMEOUT_MS}ms - הוא דולג")
+            extra["regex_warnings"] = warnings
+            continue
+        if not match_count:
+            continue
+        hits = []
+        for block in blocks:
+            size = len(json_dumps(block))
+            if (results or hits) and used_bytes + size > max_bytes:
+                truncated = True
+                break
+            hits.append(block)
+            used_bytes += size
+        if hits:
+            results.append({
+                "_id": str(doc["_id"]),
+                "title": doc.get("title", ""),
+                "language": doc.get("language", ""),
+                "match_count": match_count,
+                "hits": hits,
+            })
+            total_matches += match_count
+        if truncated:
+            break
+
+    return {
+        "count": len(results),
+        "pattern": pattern,
+        "total_matches": total_matches,
+        "truncated": truncated,
+        "results": results,
+        **extra,
+    }
+
+
+@mcp.tool()
+@profiled
+@with_response_budget
+def semantic_search(
+    query: str,
+    limit: int = 10,
+    language: Optional[str] = None,
+    rebuild: bool = False,
+) -> dict:
+    """
+    חיפוש סמנטי מקומי לפי כוונה (TF-IDF), ללא רשת וללא שירות מודלים חיצוני.
+    מתאים לשאילתות כמו "retry with backoff" גם כשהמילים המדויקות לא מופיעות בקוד.
+
+    Args:
+        query: תיאור חופשי של מה שמחפשים
+        limit: מספר תוצאות מקסימלי (ברירת מחדל: 10)
+        language: סינון אופציונלי לפי שפה
+        rebuild: בנייה מחדש של האינדקס מהמאגר ברקע; החיפוש הנוכחי רץ על האינדקס הקיים
     """
     col = get_collection()
-    query = {"code": {"$regex": pattern, "$options": "i"}}
-    if language:
-        query["language"] = {"$regex": language, "$options": "i"}
-    docs = list(col.find(query).sort("created_at", -1).limit(20))
-    return {"count": len(docs), "pattern": pattern, "snippets": [serialize_doc(d) for d in docs]}
+    index = _semantic_index
+    if not index.loaded:
+        # טעינה או בנייה ראשונה לא רצות בתוך הבקשה
+        return {"count": 0, "query": query, "snippets": [],
+                "index": "warming", "load": load_semantic_index_in_background(),
+                "hint": "האינדקס הסמנטי נטען ברקע - נסה שוב בעוד כמה שניות"}
+    rebuild_status = index.rebuild_in_background(col) if rebuild else None
+
+    # מבקשים יותר מ-limit כדי שיישארו מספיק תוצאות אחרי סינון שפה
+    with span("analysis"):
+        hits = index.search(query, limit * 5 if language else limit)
+    if not hits:
+        result = {"count": 0, "query": query, "snippets": []}
+        if rebuild_status:
+            result["rebuild"] = rebuild_status
+        return result
+
+    scores = dict(hits)
+    warnings: list[str] = []
+    mongo_query = {"_id": {"$in": [ObjectId(sid) for sid in scores]}}
+    try:
+        if language:
+            mongo_query["language"] = regex_filter(language, warnings)
+        # התקציב חל רק על שליפת התוצאות
+        with pymongo.timeout(TOOL_TIME_BUDGETS_MS["semantic_search"] / 1000):
+            docs = list(col.find(mongo_query))
+    except ValueError as e:
+        return {"error": str(e)}
+    except PyMongoError as e:
+        if not e.timeout:
+            raise
+        return {"error": "השאילתה חרגה ממגבלת הזמן"}
+    docs = sorted(docs, key=lambda d: -scores[str(d["_id"])])[:limit]
+
+    snippets = serialize_docs(docs)
+    for d in snippets:
+        d["score"] = round(scores[d["_id"]], 4)
+    result = {"count": len(snippets), "query": query, "snippets": snippets}
+    if rebuild_status:
+        result["rebuild"] = rebuild_status
+    return result
 
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def get_stats() -> dict:
     """
     סטטיסטיקות על המאגר - מספר snippets, שפות, תגיות נפוצות.
     """
+    cached = cache_get(_stats_cache, "stats")
+    if cached:
+        return cached
+
     col = get_collection()
     total = col.count_documents({})
 
-    lang_pipeline = [
-        {"$group": {"_id": "$language", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}, {"$limit": 10},
-    ]
-    languages = {d["_id"]: d["count"] for d in col.aggregate(lang_pipeline) if d["_id"]}
+    if _facet_index.loaded and _cache_mode == "change_stream":
+        # אינדקס ה-facets מעודכן מה-stream ומחזיק את הספירות - בלי $unwind על כל המאגר
+        languages = dict(_facet_index.suggest("language", "", 10)[1])
+        tags = dict(_facet_index.suggest("tags", "", 10)[1])
+    else:
+        lang_pipeline = [
+            {"$group": {"_id": "$language", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}, {"$limit": 10},
+        ]
+        languages = {d["_id"]: d["count"] for d in col.aggregate(lang_pipeline) if d["_id"]}
 
-    tag_pipeline = [
-        {"$unwind": "$tags"},
-        {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}, {"$limit": 10},
-    ]
-    tags = {d["_id"]: d["count"] for d in col.aggregate(tag_pipeline) if d["_id"]}
+        tag_pipeline = [
+            {"$unwind": "$tags"},
+            {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}, {"$limit": 10},
+        ]
+        tags = {d["_id"]: d["count"] for d in col.aggregate(tag_pipeline) if d["_id"]}
 
-    latest = col.find_one(sort=[("created_at", -1)])
+    latest = col.find_one({}, {"title": 1, "language": 1, "created_at": 1}, sort=[("created_at", -1)])
     latest_info = None
     if latest:
         ca = latest.get("created_at")
@@ -304,11 +2562,51 @@ def get_stats() -> dict:
             "created_at": ca.isoformat() if isinstance(ca, datetime) else str(ca or ""),
         }
 
-    return {
+    compression = {"compressed_snippets": 0, "original_bytes": 0, "stored_bytes": 0}
+    for d in col.aggregate([
+        {"$match": {"code_codec": {"$exists": True}}},
+        {"$group": {"_id": None, "n": {"$sum": 1},
+                    "original": {"$sum": "$code_size"}, "stored": {"$sum": "$code_stored_size"}}},
+    ]):
+        compression = {"compressed_snippets": d["n"], "original_bytes": d["original"], "stored_bytes": d["stored"]}
+    n_decompress = _codec_stats["decompress_count"]
+    compression["decompressions"] = n_decompress
+    compression["avg_decompress_ms"] = round(_codec_stats["decompress_ms"] / n_decompress, 3) if n_decompress else 0
+
+    stats = {
         "total_snippets": total,
         "languages": languages,
         "popular_tags": tags,
         "latest_snippet": latest_info,
+        "compression": compression,
+    }
+    cache_put(_stats_cache, "stats", stats)
+    return stats
+
+
+@mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
+def suggest_facets(prefix: str = "", facet: str = "tags", limit: int = 20) -> dict:
+    """
+    השלמה אוטומטית לתגיות ושפות שקיימות במאגר, עם מספר ה-snippets לכל ערך.
+    מומלץ לפני list_snippets: ערך מכאן עם exact=True הוא סינון מדויק על אינדקס.
+
+    Args:
+        prefix: תחילית לחיפוש (ללא תלות ברישיות). ריק = כל הערכים
+        facet: tags או language (ברירת מחדל: tags)
+        limit: מספר ערכים מקסימלי, מהנפוץ לנדיר (ברירת מחדל: 20)
+    """
+    if facet not in FACETS:
+        return {"error": f"facet לא מוכר: {facet} - אפשרויות: {', '.join(FACETS)}"}
+    index = get_facet_index()
+    total, matches = index.suggest(facet, prefix, max(1, min(limit, 500)))
+    return {
+        "facet": facet,
+        "prefix": prefix,
+        "total_matches": total,
+        "values": [{"value": value, "count": count} for value, count in matches],
     }
 
 
@@ -316,7 +2614,9 @@ def get_stats() -> dict:
 # │  2. Render API - תפעול ודפלוי                           │
 # └─────────────────────────────────────────────────────────┘
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_service_status(service_id: Optional[str] = None) -> dict:
     """
     בדיקת סטטוס שירות ב-Render.
@@ -329,11 +2629,11 @@ async def render_service_status(service_id: Optional[str] = None) -> dict:
     if not sid or not RENDER_API_KEY:
         return {"error": "חסר RENDER_API_KEY או RENDER_SERVICE_ID"}
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.get(f"{RENDER_API_BASE}/services/{sid}", headers=render_headers())
-        if resp.status_code != 200:
-            return {"error": f"Render API שגיאה: {resp.status_code}", "detail": resp.text}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.get(f"{RENDER_API_BASE}/services/{sid}", headers=render_headers(), timeout=15)
+    if resp.status_code != 200:
+        return {"error": f"Render API שגיאה: {resp.status_code}", "detail": resp.text}
+    data = resp.json()
 
     svc = data.get("service", data)
     return {
@@ -349,7 +2649,9 @@ async def render_service_status(service_id: Optional[str] = None) -> dict:
     }
 
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_list_deploys(
     service_id: Optional[str] = None,
     limit: int = 5,
@@ -365,15 +2667,16 @@ async def render_list_deploys(
     if not sid or not RENDER_API_KEY:
         return {"error": "חסר RENDER_API_KEY או RENDER_SERVICE_ID"}
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.get(
-            f"{RENDER_API_BASE}/services/{sid}/deploys",
-            headers=render_headers(),
-            params={"limit": limit},
-        )
-        if resp.status_code != 200:
-            return {"error": f"Render API שגיאה: {resp.status_code}"}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.get(
+        f"{RENDER_API_BASE}/services/{sid}/deploys",
+        headers=render_headers(),
+        params={"limit": limit},
+        timeout=15,
+    )
+    if resp.status_code != 200:
+        return {"error": f"Render API שגיאה: {resp.status_code}"}
+    data = resp.json()
 
     deploys = []
     for item in data:
@@ -391,7 +2694,9 @@ async def render_list_deploys(
     return {"service_id": sid, "count": len(deploys), "deploys": deploys}
 
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_trigger_deploy(
     service_id: Optional[str] = None,
     clear_cache: bool = False,
@@ -412,15 +2717,16 @@ async def render_trigger_deploy(
     if clear_cache:
         body["clearCache"] = "clear"
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(
-            f"{RENDER_API_BASE}/services/{sid}/deploys",
-            headers=render_headers(),
-            json=body,
-        )
-        if resp.status_code not in (200, 201):
-            return {"error": f"שגיאת דפלוי: {resp.status_code}", "detail": resp.text}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.post(
+        f"{RENDER_API_BASE}/services/{sid}/deploys",
+        headers=render_headers(),
+        json=body,
+        timeout=30,
+    )
+    if resp.status_code not in (200, 201):
+        return {"error": f"שגיאת דפלוי: {resp.status_code}", "detail": resp.text}
+    data = resp.json()
 
     d = data.get("deploy", data)
     return {
@@ -430,7 +2736,9 @@ async def render_trigger_deploy(
     }
 
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_restart_service(service_id: Optional[str] = None) -> dict:
     """
     ריסטארט לשירות ב-Render (ללא בנייה מחדש).
@@ -443,18 +2751,21 @@ async def render_restart_service(service_id: Optional[str] = None) -> dict:
     if not sid or not RENDER_API_KEY:
         return {"error": "חסר RENDER_API_KEY או RENDER_SERVICE_ID"}
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.post(
-            f"{RENDER_API_BASE}/services/{sid}/restart",
-            headers=render_headers(),
-        )
-        if resp.status_code not in (200, 204):
-            return {"error": f"שגיאת restart: {resp.status_code}", "detail": resp.text}
+    client = get_http_client()
+    resp = await client.post(
+        f"{RENDER_API_BASE}/services/{sid}/restart",
+        headers=render_headers(),
+        timeout=15,
+    )
+    if resp.status_code not in (200, 204):
+        return {"error": f"שגיאת restart: {resp.status_code}", "detail": resp.text}
 
     return {"message": f"שירות {sid} הופעל מחדש בהצלחה"}
 
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_get_logs(
     service_id: Optional[str] = None,
     start_time: Optional[str] = None,
@@ -511,15 +2822,16 @@ async def render_get_logs(
     if level:
         params["level"] = level
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(
-            f"{RENDER_API_BASE}/logs",
-            headers=render_headers(),
-            params=params,
-        )
-        if resp.status_code != 200:
-            return {"error": f"Render Logs API שגיאה: {resp.status_code}", "detail": resp.text}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.get(
+        f"{RENDER_API_BASE}/logs",
+        headers=render_headers(),
+        params=params,
+        timeout=30,
+    )
+    if resp.status_code != 200:
+        return {"error": f"Render Logs API שגיאה: {resp.status_code}", "detail": resp.text}
+    data = resp.json()
 
     # פירוק הלוגים - כל לוג מכיל labels כמערך של {name, value}
     logs = []
@@ -556,7 +2868,9 @@ async def render_get_logs(
     return result
 
 
-@mcp.tool()
+@integration_tool(bool(RENDER_API_KEY))
+@profiled
+@with_response_budget
 async def render_get_env_vars(service_id: Optional[str] = None) -> dict:
     """
     הצגת משתני הסביבה של שירות ב-Render.
@@ -569,14 +2883,15 @@ async def render_get_env_vars(service_id: Optional[str] = None) -> dict:
     if not sid or not RENDER_API_KEY:
         return {"error": "חסר RENDER_API_KEY או RENDER_SERVICE_ID"}
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.get(
-            f"{RENDER_API_BASE}/services/{sid}/env-vars",
-            headers=render_headers(),
-        )
-        if resp.status_code != 200:
-            return {"error": f"שגיאה: {resp.status_code}"}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.get(
+        f"{RENDER_API_BASE}/services/{sid}/env-vars",
+        headers=render_headers(),
+        timeout=15,
+    )
+    if resp.status_code != 200:
+        return {"error": f"שגיאה: {resp.status_code}"}
+    data = resp.json()
 
     env_vars = []
     sensitive_patterns = ("KEY", "SECRET", "TOKEN", "PASSWORD", "URI", "URL", "MONGO")
@@ -598,7 +2913,9 @@ async def render_get_env_vars(service_id: Optional[str] = None) -> dict:
 # │  3. GitHub - Issues ופעולות                             │
 # └─────────────────────────────────────────────────────────┘
 
-@mcp.tool()
+@integration_tool(bool(GITHUB_TOKEN))
+@profiled
+@with_response_budget
 async def github_create_issue(
     title: str,
     body: str,
@@ -622,15 +2939,16 @@ async def github_create_issue(
     if labels:
         payload["labels"] = labels
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.post(
-            f"{GITHUB_API_BASE}/repos/{target_repo}/issues",
-            headers=github_headers(),
-            json=payload,
-        )
-        if resp.status_code != 201:
-            return {"error": f"GitHub שגיאה: {resp.status_code}", "detail": resp.text}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.post(
+        f"{GITHUB_API_BASE}/repos/{target_repo}/issues",
+        headers=github_headers(),
+        json=payload,
+        timeout=15,
+    )
+    if resp.status_code != 201:
+        return {"error": f"GitHub שגיאה: {resp.status_code}", "detail": resp.text}
+    data = resp.json()
 
     return {
         "message": "Issue נוצר בהצלחה",
@@ -640,7 +2958,9 @@ async def github_create_issue(
     }
 
 
-@mcp.tool()
+@integration_tool(bool(GITHUB_TOKEN))
+@profiled
+@with_response_budget
 async def github_list_issues(
     state: str = "open",
     labels: Optional[str] = None,
@@ -664,15 +2984,16 @@ async def github_list_issues(
     if labels:
         params["labels"] = labels
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.get(
-            f"{GITHUB_API_BASE}/repos/{target_repo}/issues",
-            headers=github_headers(),
-            params=params,
-        )
-        if resp.status_code != 200:
-            return {"error": f"GitHub שגיאה: {resp.status_code}"}
-        data = resp.json()
+    client = get_http_client()
+    resp = await client.get(
+        f"{GITHUB_API_BASE}/repos/{target_repo}/issues",
+        headers=github_headers(),
+        params=params,
+        timeout=15,
+    )
+    if resp.status_code != 200:
+        return {"error": f"GitHub שגיאה: {resp.status_code}"}
+    data = resp.json()
 
     issues = []
     for issue in data:
@@ -695,6 +3016,9 @@ async def github_list_issues(
 # └─────────────────────────────────────────────────────────┘
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def analyze_snippet(snippet_id: str) -> dict:
     """
     ניתוח בסיסי של snippet - שורות, מורכבות, דפוסים בעייתיים.
@@ -703,133 +3027,189 @@ def analyze_snippet(snippet_id: str) -> dict:
     Args:
         snippet_id: מזהה ה-snippet לניתוח
     """
+    cached = cache_get(_analysis_cache, snippet_id)
+    if cached:
+        return cached
+
     col = get_collection()
-    doc = col.find_one({"_id": ObjectId(snippet_id)})
+    doc = unpack_code(col.find_one({"_id": ObjectId(snippet_id)}))
     if not doc:
         return {"error": f"snippet {snippet_id} לא נמצא"}
 
-    code = doc.get("code", "")
-    lines = code.split("\n")
-    lang = doc.get("language", "unknown").lower()
+    with span("analysis"):
+        code = doc.get("code", "")
+        lines = code.split("\n")
+        lang = doc.get("language", "unknown").lower()
+
+        analysis = {
+            "snippet_id": snippet_id,
+            "title": doc.get("title", ""),
+            "language": lang,
+            "metrics": {
+                "total_lines": len(lines),
+                "code_lines": len([l for l in lines if l.strip() and not l.strip().startswith("#")
+                                    and not l.strip().startswith("//")
+                                    and not l.strip().startswith("/*")]),
+                "empty_lines": len([l for l in lines if not l.strip()]),
+                "comment_lines": len([l for l in lines if l.strip().startswith("#")
+                                       or l.strip().startswith("//")]),
+                "max_line_length": max((len(l) for l in lines), default=0),
+                "avg_line_length": round(sum(len(l) for l in lines) / max(len(lines), 1), 1),
+            },
+            "patterns_found": [],
+            "suggestions": [],
+        }
 
-    analysis = {
-        "snippet_id": snippet_id,
-        "title": doc.get("title", ""),
-        "language": lang,
-        "metrics": {
-            "total_lines": len(lines),
-            "code_lines": len([l for l in lines if l.strip() and not l.strip().startswith("#")
-                                and not l.strip().startswith("//")
-                                and not l.strip().startswith("/*")]),
-            "empty_lines": len([l for l in lines if not l.strip()]),
-            "comment_lines": len([l for l in lines if l.strip().startswith("#")
-                                   or l.strip().startswith("//")]),
-            "max_line_length": max((len(l) for l in lines), default=0),
-            "avg_line_length": round(sum(len(l) for l in lines) / max(len(lines), 1), 1),
-        },
-        "patterns_found": [],
-        "suggestions": [],
-    }
+        # זיהוי דפוסים בעייתיים
+        problem_patterns = {
+            "TODO/FIXME": r"(?i)(todo|fixme|hack|xxx)",
+            "print_debug": r"(?i)\b(print\(|console\.log|debugger)",
+            "bare_except": r"except\s*:",
+            "hardcoded_secrets": r"(?i)(password|secret|api_key|token)\s*=\s*['\"][^'\"]+['\"]",
+            "long_function": None,  # נבדק בנפרד
+            "nested_loops": r"(for|while).*\n\s+(for|while)",
+        }
 
-    # זיהוי דפוסים בעייתיים
-    problem_patterns = {
-        "TODO/FIXME": r"(?i)(todo|fixme|hack|xxx)",
-        "print_debug": r"(?i)\b(print\(|console\.log|debugger)",
-        "bare_except": r"except\s*:",
-        "hardcoded_secrets": r"(?i)(password|secret|api_key|token)\s*=\s*['\"][^'\"]+['\"]",
-        "long_function": None,  # נבדק בנפרד
-        "nested_loops": r"(for|while).*\n\s+(for|while)",
-    }
+        for name, pattern in problem_patterns.items():
+            if pattern:
+                matches = re.findall(pattern, code)
+                if matches:
+                    analysis["patterns_found"].append({
+                        "pattern": name,
+                        "count": len(matches),
+                    })
 
-    for name, pattern in problem_patterns.items():
-        if pattern:
-            matches = re.findall(pattern, code)
-            if matches:
+        # בדיקת פונקציות ארוכות (Python)
+        if lang == "python":
+            func_lengths = []
+            current_func = None
+            current_lines = 0
+            for line in lines:
+                if re.match(r"^(async\s+)?def\s+", line):
+                    if current_func and current_lines > 30:
+                        analysis["patterns_found"].append({
+                            "pattern": "long_function",
+                            "detail": f"{current_func}: {current_lines} שורות",
+                        })
+                    current_func = line.strip().split("(")[0].replace("def ", "").replace("async ", "")
+                    current_lines = 0
+                elif current_func:
+                    current_lines += 1
+
+            if current_func and current_lines > 30:
                 analysis["patterns_found"].append({
-                    "pattern": name,
-                    "count": len(matches),
+                    "pattern": "long_function",
+                    "detail": f"{current_func}: {current_lines} שורות",
                 })
 
-    # בדיקת פונקציות ארוכות (Python)
-    if lang == "python":
-        func_lengths = []
-        current_func = None
-        current_lines = 0
-        for line in lines:
-            if re.match(r"^(async\s+)?def\s+", line):
-                if current_func and current_lines > 30:
-                    analysis["patterns_found"].append({
-                        "pattern": "long_function",
-                        "detail": f"{current_func}: {current_lines} שורות",
-                    })
-                current_func = line.strip().split("(")[0].replace("def ", "").replace("async ", "")
-                current_lines = 0
-            elif current_func:
-                current_lines += 1
-
-        if current_func and current_lines > 30:
-            analysis["patterns_found"].append({
-                "pattern": "long_function",
-                "detail": f"{current_func}: {current_lines} שורות",
-            })
-
-    # הצעות
-    m = analysis["metrics"]
-    if m["max_line_length"] > 120:
-        analysis["suggestions"].append("יש שורות ארוכות מ-120 תווים — שקול לפצל")
-    if m["comment_lines"] == 0 and m["code_lines"] > 20:
-        analysis["suggestions"].append("אין הערות בקוד — שקול להוסיף תיעוד")
-    if not analysis["patterns_found"]:
-        analysis["suggestions"].append("לא נמצאו דפוסים בעייתיים — הקוד נראה נקי")
+        # הצעות
+        m = analysis["metrics"]
+        if m["max_line_length"] > 120:
+            analysis["suggestions"].append("יש שורות ארוכות מ-120 תווים — שקול לפצל")
+        if m["comment_lines"] == 0 and m["code_lines"] > 20:
+            analysis["suggestions"].append("אין הערות בקוד — שקול להוסיף תיעוד")
+        if not analysis["patterns_found"]:
+            analysis["suggestions"].append("לא נמצאו דפוסים בעייתיים — הקוד נראה נקי")
 
+    cache_put(_analysis_cache, snippet_id, analysis)
     return analysis
 
 
 @mcp.tool()
+@profiled
+@with_response_budget
+@with_time_budget
 def bulk_tag_snippets(
     language: Optional[str] = None,
     search: Optional[str] = None,
     add_tags: Optional[list[str]] = None,
     remove_tags: Optional[list[str]] = None,
+    dry_run: bool = False,
+    sample_size: int = 5,
 ) -> dict:
     """
     עדכון תגיות בכמות (bulk) על snippets מסוננים.
+    רק snippets שהתגיות שלהם באמת ישתנו נכתבים. תגית שמופיעה גם בהוספה וגם בהסרה - מוסרת.
 
     Args:
         language: סינון לפי שפה
         search: סינון לפי טקסט
         add_tags: תגיות להוספה
         remove_tags: תגיות להסרה
+        dry_run: תצוגה מקדימה בלבד - ספירה מדויקת ודוגמה, ללא כתיבה
+        sample_size: מספר snippets לדוגמה ב-dry_run (ברירת מחדל: 5)
     """
     col = get_collection()
-    query = {}
-    if language:
-        query["language"] = {"$regex": language, "$options": "i"}
-    if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"code": {"$regex": search, "$options": "i"}},
-        ]
-
-    count = col.count_documents(query)
-    if count == 0:
-        return {"error": "לא נמצאו snippets תואמים"}
+    warnings: list[str] = []
+    try:
+        query = {}
+        if language:
+            query["language"] = regex_filter(language, warnings)
+        if search:
+            query["$or"] = code_search_clause(col, guard_regex(search, warnings), ("title", "code"),
+                                              dict(query), warnings)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    remove_tags = list(dict.fromkeys(remove_tags or []))
+    add_tags = [t for t in dict.fromkeys(add_tags or []) if t not in remove_tags]
+    if not add_tags and not remove_tags:
+        return {"error": "לא צוינו תגיות להוספה או הסרה"}
 
-    operations = {}
+    # רק מסמכים שבאמת ישתנו: חסרה להם תגית להוספה או שיש להם תגית להסרה
+    change_filters = []
     if add_tags:
-        operations["$addToSet"] = {"tags": {"$each": add_tags}}
+        change_filters.append({"tags": {"$not": {"$all": add_tags}}})
     if remove_tags:
-        operations["$pull"] = {"tags": {"$in": remove_tags}}
-
-    if not operations:
-        return {"error": "לא צוינו תגיות להוספה או הסרה"}
+        change_filters.append({"tags": {"$in": remove_tags}})
+    change = change_filters[0] if len(change_filters) == 1 else {"$or": change_filters}
+    change_match = {"$and": [query, change]} if query else change
+
+    if dry_run:
+        facets = next(col.aggregate([
+            {"$match": query},
+            {"$facet": {
+                "matched": [{"$count": "n"}],
+                "would_change": [{"$match": change_match}, {"$count": "n"}],
+                "sample": [
+                    {"$match": change_match},
+                    {"$limit": max(0, min(sample_size, 50))},
+                    {"$project": {"title": 1, "language": 1, "tags": 1}},
+                ],
+            }},
+        ]))
+        response = {
+            "dry_run": True,
+            "matched": facets["matched"][0]["n"] if facets["matched"] else 0,
+            "would_change": facets["would_change"][0]["n"] if facets["would_change"] else 0,
+            "add_tags": add_tags,
+            "remove_tags": remove_tags,
+            "sample": serialize_docs(facets["sample"]),
+        }
+    else:
+        # עדכון pipeline יחיד - מעבר אחד על האוסף, ו-modified סופר כל snippet פעם אחת.
+        # הסדר נשמר כמו ב-$pull ו-$addToSet: קודם מסירים, ואז מוסיפים בסוף את מה שחסר
+        current = {"$ifNull": ["$tags", []]}
+        kept = {"$filter": {"input": current, "as": "t",
+                            "cond": {"$not": {"$in": ["$$t", {"$literal": remove_tags}]}}}}
+        missing = {"$filter": {"input": {"$literal": add_tags}, "as": "t",
+                               "cond": {"$not": {"$in": ["$$t", current]}}}}
+        result = col.update_many(change_match, [{"$set": {"tags": {"$concatArrays": [kept, missing]}}}])
+        _stats_cache.clear()
+        if result.modified_count and _cache_mode != "change_stream":
+            # בלי change stream אין עדכון לפי מסמך - אינדקס ה-facets נבנה מחדש בשימוש הבא
+            _facet_index.invalidate()
+        modified = result.modified_count
+        response = {
+            "message": f"בוצעו {modified} עדכוני תגיות" if modified else "לא נדרש שינוי - התגיות כבר מעודכנות",
+            "modified": modified,
+            "add_tags": add_tags,
+            "remove_tags": remove_tags,
+        }
 
-    result = col.update_many(query, operations)
-    return {
-        "message": f"עודכנו {result.modified_count} snippets מתוך {count}",
-        "matched": count,
-        "modified": result.modified_count,
-    }
+    if warnings:
+        response["regex_warnings"] = warnings
+    return response
 
 
 # ┌─────────────────────────────────────────────────────────┐
@@ -876,7 +3256,7 @@ def debug_help(error_message: str, context: str = "") -> str:
     )
 
 
-@mcp.prompt()
+@integration_prompt(bool(GITHUB_TOKEN))
 def create_github_issue_prompt(
     issue_type: str = "bug",
     description: str = "",
@@ -925,21 +3305,23 @@ def create_github_issue_prompt(
     return templates.get(issue_type, templates["bug"])
 
 
-@mcp.prompt()
+@integration_prompt(bool(RENDER_API_KEY))
 def deploy_check() -> str:
     """
     בדיקה לפני דפלוי - אישור בטיחות.
     """
+    with_github = "github_list_issues" not in _skipped_tools
     return (
         "אתה עומד לבצע דפלוי.\n"
         "קודם כל, בצע את הבדיקות הבאות:\n\n"
         "1. **הפעל** render_service_status כדי לבדוק את מצב השירות הנוכחי\n"
         "2. **הפעל** render_list_deploys כדי לראות את הדפלוי האחרון\n"
-        "3. **הפעל** github_list_issues עם labels='bug' כדי לבדוק באגים פתוחים\n\n"
-        "לאחר מכן, הצג למשתמש:\n"
+        + ("3. **הפעל** github_list_issues עם labels='bug' כדי לבדוק באגים פתוחים\n" if with_github else "")
+        + "\nלאחר מכן, הצג למשתמש:\n"
         "- מצב השירות הנוכחי\n"
         "- תוצאת הדפלוי האחרון\n"
-        "- באגים פתוחים שעלולים להשפיע\n\n"
+        + ("- באגים פתוחים שעלולים להשפיע\n" if with_github else "")
+        + "\n"
         "שאל את המשתמש אם להמשיך עם הדפלוי.\n"
         "אם הוא מאשר, השתמש ב-render_trigger_deploy.\n\n"
         "⚠️ אל תבצע דפלוי ללא אישור מפורש!"
@@ -1005,17 +3387,30 @@ def stats_resource() -> str:
 
 @mcp.resource("codebot://tools-guide")
 def tools_guide_resource() -> str:
-    """מדריך לכלים הזמינים בשרת"""
-    return """# כלים זמינים ב-CodeBot MCP Server
+    """מדריך לכלים הזמינים בשרת - כלי אינטגרציה שלא נרשמו לא מופיעים"""
+    sections = []
+    for section in _TOOLS_GUIDE.split("\n\n"):
+        lines = [line for line in section.split("\n")
+                 if not (line.startswith("- `") and line[3:].split("`", 1)[0] in _skipped_tools)]
+        if any(line.startswith("- ") for line in lines) or not section.startswith("## "):
+            sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+
+_TOOLS_GUIDE = """# כלים זמינים ב-CodeBot MCP Server
 
 ## ניהול קוד
 - `list_snippets` - רשימת snippets עם סינון
-- `get_snippet` - קבלת snippet בודד
+- `get_snippet` - קבלת snippet בודד (גוף גדול בחלקים: start_line/max_lines)
 - `create_snippet` - יצירת snippet חדש
 - `update_snippet` - עדכון snippet
 - `delete_snippet` - מחיקת snippet
+- `list_snippet_versions` - היסטוריית גרסאות של snippet
+- `get_snippet_version` - קוד של גרסה קודמת
 - `search_by_code` - חיפוש בתוך הקוד
+- `semantic_search` - חיפוש סמנטי מקומי לפי כוונה
 - `get_stats` - סטטיסטיקות
+- `suggest_facets` - השלמת תגיות ושפות קיימות (ואז `list_snippets` עם `exact=True`)
 
 ## ניתוח קוד
 - `analyze_snippet` - ניתוח מטריקות ודפוסים
@@ -1039,8 +3434,94 @@ def tools_guide_resource() -> str:
 # │  7. Health Check                                       │
 # └─────────────────────────────────────────────────────────┘
 
+# ה-probe רץ ברקע בכל worker ושומר את המצב האחרון; /health רק מחזיר אותו,
+# כך שבדיקת בריאות לעולם לא ממתינה ל-Mongo או ל-API חיצוני.
+
+_probes: dict[str, dict] = {}
+_prober_running = False
+
+
+async def _probe(name: str, check) -> None:
+    from starlette.concurrency import run_in_threadpool
+
+    state = _probes.setdefault(name, {"status": "pending", "last_success": None})
+    started = time.perf_counter()
+    try:
+        if asyncio.iscoroutinefunction(check):
+            detail = await check()
+        else:
+            detail = await run_in_threadpool(check)
+        state["status"] = "ok"
+        state["last_success"] = datetime.now(timezone.utc).isoformat()
+        state.pop("error", None)
+        if detail:
+            state["detail"] = detail
+    except Exception as e:
+        state["status"] = "error"
+        state["error"] = str(e)
+    state["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    state["checked_at"] = time.monotonic()
+
+
+def _ping_mongo():
+    with pymongo.timeout(HEALTH_PROBE_TIMEOUT):
+        get_collection().database.client.admin.command("ping")
+
+
+async def _ping_render():
+    resp = await get_http_client().get(
+        f"{RENDER_API_BASE}/owners", headers=render_headers(),
+        params={"limit": 1}, timeout=HEALTH_PROBE_TIMEOUT,
+    )
+    resp.raise_for_status()
+
+
+async def _ping_github():
+    # rate_limit לא נספר במכסת הבקשות של GitHub
+    resp = await get_http_client().get(
+        f"{GITHUB_API_BASE}/rate_limit", headers=github_headers(), timeout=HEALTH_PROBE_TIMEOUT,
+    )
+    resp.raise_for_status()
+    core = resp.json().get("resources", {}).get("core", {})
+    return {"rate_remaining": core.get("remaining")}
+
+
+async def run_health_prober():
+    """לולאת ה-probe - Mongo תמיד, Render ו-GitHub רק כש-HEALTH_PROBE_EXTERNAL מופעל."""
+    global _prober_running
+    _prober_running = True
+    try:
+        while True:
+            checks = [_probe("mongodb", _ping_mongo)]
+            if HEALTH_PROBE_EXTERNAL and RENDER_API_KEY:
+                checks.append(_probe("render", _ping_render))
+            if HEALTH_PROBE_EXTERNAL and GITHUB_TOKEN:
+                checks.append(_probe("github", _ping_github))
+            await asyncio.gather(*checks)
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+    finally:
+        _prober_running = False
+
+
+def _probe_view(name: str) -> dict:
+    state = _probes.get(name)
+    if not state:
+        return {"status": "pending"}
+    view = {k: v for k, v in state.items() if k != "checked_at"}
+    if "checked_at" in state:
+        view["age_s"] = round(time.monotonic() - state["checked_at"], 1)
+    return view
+
+
+def _mongo_probe_healthy() -> bool:
+    state = _probes.get("mongodb", {})
+    fresh = time.monotonic() - state.get("checked_at", float("-inf")) < HEALTH_PROBE_INTERVAL * 3
+    return state.get("status") == "ok" and fresh
+
+
 @mcp.custom_route("/health", methods=["GET"])
 async def health_check(request):
+    """liveness - מחזיר מיד את המצב האחרון שה-probe רשם, בלי לגשת ל-Mongo."""
     from starlette.responses import JSONResponse
 
     health = {
@@ -1051,30 +3532,452 @@ async def health_check(request):
     }
 
     # MongoDB
-    try:
-        col = get_collection()
-        col.find_one()
-        health["integrations"]["mongodb"] = "connected"
-    except Exception as e:
-        health["integrations"]["mongodb"] = f"error: {str(e)}"
+    health["integrations"]["mongodb"] = _probe_view("mongodb")
+    if _prober_running and not _mongo_probe_healthy():
         health["status"] = "degraded"
 
+    health["integrations"]["cache"] = _cache_mode
+    health["startup"] = _startup
+    if _insert_batcher is not None:
+        health["write_coalescing"] = _insert_batcher.stats
+
     # Render API
-    health["integrations"]["render"] = "configured" if RENDER_API_KEY else "not configured"
+    if "render" in _probes:
+        health["integrations"]["render"] = _probe_view("render")
+    else:
+        health["integrations"]["render"] = "configured" if RENDER_API_KEY else "not configured"
 
     # GitHub API
-    health["integrations"]["github"] = "configured" if GITHUB_TOKEN else "not configured"
+    if "github" in _probes:
+        health["integrations"]["github"] = _probe_view("github")
+    else:
+        health["integrations"]["github"] = "configured" if GITHUB_TOKEN else "not configured"
 
     return JSONResponse(health)
 
 
+# ── Warm-up ו-readiness ──
+# בעליית worker רצה משימת warm-up ברקע: pool של Mongo, HTTP client, מזהה הבעלים
+# ב-Render והאינדקס הסמנטי. /health עונה מיד (liveness), ו-/ready מחזיר 503 עד
+# שה-warm-up הסתיים - כך הפלטפורמה מנתבת תעבורה רק אחרי שעלות ה-cold start שולמה.
+
+_readiness = {"ready": not WARMUP_ON_START, "steps": {}, "started_at": None, "finished_at": None}
+
+
+async def _warm_step(name: str, func, in_thread: bool = False, required: bool = False) -> bool:
+    """הרצת שלב warm-up ורישום משך ותוצאה. פעולות Mongo חוסמות רצות ב-threadpool."""
+    from starlette.concurrency import run_in_threadpool
+
+    started = time.perf_counter()
+    try:
+        if in_thread:
+            await run_in_threadpool(func)
+        else:
+            result = func()
+            if asyncio.iscoroutine(result):
+                await result
+    except Exception as e:
+        _readiness["steps"][name] = {"status": f"error: {e}", "ms": round((time.perf_counter() - started) * 1000, 1)}
+        (logger.error if required else logger.warning)(f"warm-up {name} נכשל: {e}")
+        return False
+    _readiness["steps"][name] = {"status": "ok", "ms": round((time.perf_counter() - started) * 1000, 1)}
+    return True
+
+
+def _warm_mongo():
+    col = get_collection()
+    col.database.client.admin.command("ping")
+    get_versions_collection()
+
+
+def _warm_facets():
+    get_facet_index()
+    ensure_facet_indexes(get_collection())
+
+
+async def warm_up():
+    """warm-up מלא. Mongo הוא שלב חובה ונוסה שוב עד הצלחה; שאר השלבים best-effort."""
+    _readiness["started_at"] = datetime.now(timezone.utc).isoformat()
+    delay = 1.0
+    while not await _warm_step("mongodb", _warm_mongo, in_thread=True, required=True):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+    if RENDER_API_KEY or GITHUB_TOKEN:
+        await _warm_step("http_client", get_http_client)
+    if RENDER_API_KEY:
+        await _warm_step("render_owner", _resolve_render_owner)
+    await _warm_step("semantic_index", get_semantic_index, in_thread=True)
+    # גם אם האינדקס לא נטען - caches ו-facets עדיין צריכים את ה-stream
+    await _warm_step("change_stream", start_change_stream, in_thread=True)
+    await _warm_step("facets", _warm_facets, in_thread=True)
+    _readiness["ready"] = True
+    _readiness["finished_at"] = datetime.now(timezone.utc).isoformat()
+    _startup["warmup_done_ms"] = _boot_elapsed_ms()
+    logger.info(f"warm-up הסתיים: {_readiness['steps']}")
+
+
+@mcp.custom_route("/ready", methods=["GET"])
+async def ready_check(request):
+    """readiness עמוק - warm-up הסתיים וה-probe האחרון של Mongo הצליח ועדכני."""
+    from starlette.responses import JSONResponse
+
+    ready = _readiness["ready"] and (not _prober_running or _mongo_probe_healthy())
+    body = {
+        "ready": ready,
+        "warmup": {"steps": _readiness["steps"], "started_at": _readiness["started_at"],
+                   "finished_at": _readiness["finished_at"]},
+        "probes": {name: _probe_view(name) for name in _probes},
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+# ┌─────────────────────────────────────────────────────────┐
+# │  8. ייצוא / ייבוא NDJSON                                │
+# └─────────────────────────────────────────────────────────┘
+# כל שורה היא snippet אחד ב-MongoDB Extended JSON, כך ש-ObjectId ותאריכים
+# נשמרים בגיבוי ובשחזור. הנתיבים פעילים רק כש-ADMIN_TOKEN מוגדר.
+
+def _check_admin(request) -> Optional[str]:
+    """מחזיר הודעת שגיאה אם הבקשה לא מורשית לנתיבי ניהול."""
+    if not ADMIN_TOKEN:
+        return "נתיב ניהול מושבת - יש להגדיר ADMIN_TOKEN"
+    # השוואה בזמן קבוע - בלי דליפת אורך הקידומת התואם דרך זמן התגובה
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        return "לא מורשה"
+    return None
+
+
+def _compressor(codec: str):
+    if codec == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if codec == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return None
+
+
+def _decompressor(codec: str):
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    if codec == "zstd" and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def _export_lines(query: dict, batch_size: int, codec: str):
+    """גנרטור סינכרוני - Starlette מריץ אותו ב-threadpool, והזיכרון נשאר קבוע לאורך הייצוא."""
+    compressor = _compressor(codec)
+    cursor = get_collection().find(query).sort("_id", 1).batch_size(batch_size)
+    buf = []
+    buf_size = 0
+    for doc in cursor:
+        line = json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n"
+        buf.append(line)
+        buf_size += len(line)
+        if buf_size >= EXPORT_CHUNK_BYTES:
+            chunk = "".join(buf).encode()
+            buf, buf_size = [], 0
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = "".join(buf).encode()
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+
+@mcp.custom_route("/export", methods=["GET"])
+async def export_snippets(request):
+    """
+    ייצוא המאגר כ-NDJSON בזרימה.
+    פרמטרים: compress=gzip|zstd, batch_size, after_id (להמשך ייצוא שנקטע).
+    """
+    from starlette.responses import JSONResponse, StreamingResponse
+
+    denied = _check_admin(request)
+    if denied:
+        return JSONResponse({"error": denied}, status_code=403)
+
+    codec = request.query_params.get("compress", "")
+    if codec and not _compressor(codec):
+        return JSONResponse({"error": f"דחיסה לא נתמכת: {codec}"}, status_code=400)
+    try:
+        batch_size = max(1, min(int(request.query_params.get("batch_size", 500)), 5000))
+    except ValueError:
+        return JSONResponse({"error": "batch_size חייב להיות מספר שלם"}, status_code=400)
+    query = {}
+    after_id = request.query_params.get("after_id")
+    if after_id:
+        if not ObjectId.is_valid(after_id):
+            return JSONResponse({"error": f"after_id לא תקין: {after_id}"}, status_code=400)
+        query["_id"] = {"$gt": ObjectId(after_id)}
+
+    headers = {"Content-Disposition": f"attachment; filename={COLLECTION_NAME}.ndjson"}
+    if codec:
+        headers["Content-Encoding"] = codec
+    return StreamingResponse(
+        _export_lines(query, batch_size, codec),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+def _pack_import_doc(doc: dict) -> dict:
+    """דחיסת גוף קוד גדול כמו בכתיבה רגילה. מסמך שיוצא כבר דחוס נשמר כמו שהוא."""
+    code = doc.get("code")
+    if isinstance(code, str):
+        for f in _CODE_CODEC_FIELDS:
+            doc.pop(f, None)
+        doc.update(pack_code(code)[0])
+    return doc
+
+
+def _parse_import_line(raw: bytes) -> dict:
+    doc = json_util.loads(raw)
+    if not isinstance(doc, dict):
+        raise ValueError(f"שורה חייבת להיות אובייקט JSON, התקבל {type(doc).__name__}")
+    return doc
+
+
+def _write_import_batch(docs: list[dict]) -> tuple[int, int, list[str]]:
+    """כתיבת אצווה: מסמך עם _id → upsert, בלי _id → insert. מחזיר (נוספו, עודכנו, שגיאות)."""
+    docs = [_pack_import_doc(d) for d in docs]
+    requests = [
+        ReplaceOne({"_id": d["_id"]}, d, upsert=True) if "_id" in d else InsertOne(d)
+        for d in docs
+    ]
+    try:
+        result = get_collection().bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        details = e.details
+        errors = [err.get("errmsg", "") for err in details.get("writeErrors", [])]
+        inserted = details.get("nInserted", 0) + details.get("nUpserted", 0)
+        return inserted, details.get("nModified", 0), errors
+    return result.inserted_count + result.upserted_count, result.modified_count, []
+
+
+@mcp.custom_route("/import", methods=["POST"])
+async def import_snippets(request):
+    """
+    ייבוא NDJSON בזרימה (Content-Encoding: gzip/zstd נתמך).
+    פרמטרים: batch_size, import_id - מזהה לנקודת שמירה; שליחה חוזרת של אותו קובץ
+    עם אותו import_id מדלגת על השורות שכבר נכתבו.
+    """
+    from starlette.concurrency import run_in_threadpool
+    from starlette.responses import JSONResponse
+
+    denied = _check_admin(request)
+    if denied:
+        return JSONResponse({"error": denied}, status_code=403)
+
+    codec = request.headers.get("content-encoding", "")
+    decompressor = _decompressor(codec) if codec else None
+    if codec and not decompressor:
+        return JSONResponse({"error": f"דחיסה לא נתמכת: {codec}"}, status_code=400)
+    try:
+        batch_size = max(1, min(int(request.query_params.get("batch_size", 500)), 5000))
+    except ValueError:
+        return JSONResponse({"error": "batch_size חייב להיות מספר שלם"}, status_code=400)
+    import_id = request.query_params.get("import_id")
+
+    checkpoints = get_collection().database[f"{COLLECTION_NAME}_import_checkpoints"]
+    skip = 0
+    if import_id:
+        cp = await run_in_threadpool(checkpoints.find_one, {"_id": import_id})
+        skip = cp["lines_done"] if cp else 0
+
+    stats = {"lines": 0, "skipped": skip, "inserted": 0, "updated": 0, "errors": []}
+    line_no = 0
+    batch: list[dict] = []
+    pending = b""
+
+    async def flush():
+        nonlocal batch
+        # ההמתנה לכתיבה לפני קריאת המשך הגוף היא ה-backpressure מול הלקוח
+        inserted, updated, errors = await run_in_threadpool(_write_import_batch, batch)
+        stats["inserted"] += inserted
+        stats["updated"] += updated
+        stats["errors"].extend(errors[:20 - len(stats["errors"])])
+        batch = []
+        if import_id:
+            await run_in_threadpool(
+                checkpoints.update_one,
+                {"_id": import_id},
+                {"$set": {"lines_done": line_no, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+
+    try:
+        async for chunk in request.stream():
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for raw in lines:
+                line_no += 1
+                if line_no <= skip or not raw.strip():
+                    continue
+                batch.append(_parse_import_line(raw))
+                stats["lines"] += 1
+                if len(batch) >= batch_size:
+                    await flush()
+        if pending.strip():
+            line_no += 1
+            if line_no > skip:
+                batch.append(_parse_import_line(pending))
+                stats["lines"] += 1
+        if batch:
+            await flush()
+    except (ValueError, TypeError, bson.errors.InvalidDocument, PyMongoError) as e:
+        stats["error"] = f"הייבוא נעצר בשורה {line_no}: {e}"
+        stats["resume_from_line"] = line_no - len(batch)
+        return JSONResponse(stats, status_code=400)
+    finally:
+        if stats["inserted"] or stats["updated"]:
+            _invalidate_after_import()
+
+    stats["message"] = f"יובאו {stats['inserted'] + stats['updated']} snippets"
+    return JSONResponse(stats)
+
+
+def _invalidate_after_import():
+    """
+    ייבוא כותב ישירות לאוסף. עם change stream כל מסמך מגיע גם כאירוע; בלעדיו
+    ה-caches מתאפסים, אינדקס ה-facets נבנה מחדש בשימוש הבא והאינדקס הסמנטי ברקע.
+    """
+    invalidate_all()
+    if _cache_mode != "change_stream":
+        _facet_index.invalidate()
+        if _semantic_index.loaded:
+            _semantic_index.rebuild_in_background(get_collection())
+
+
+# ┌─────────────────────────────────────────────────────────┐
+# │  9. פרופיילינג                                         │
+# └─────────────────────────────────────────────────────────┘
+# נתיבי ניהול (ADMIN_TOKEN) לקריאות האיטיות האחרונות ול-snapshot של profiler
+# דוגם. שניהם מכסים את ה-worker שענה לבקשה בלבד.
+
+_sampler_lock = threading.Lock()
+
+
+def _sample_stacks(seconds: float, interval: float) -> tuple[int, collections.Counter]:
+    """דגימת ה-stack של כל ה-threads כל interval שניות, בפורמט collapsed (thread;file:func;...)."""
+    own = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks: collections.Counter = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident)), *reversed(frames)])] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+@mcp.custom_route("/debug/slow-calls", methods=["GET"])
+async def slow_calls(request):
+    """הקריאות האיטיות האחרונות (עד 100) ב-worker הנוכחי, מהחדשה לישנה."""
+    from starlette.responses import JSONResponse
+
+    denied = _check_admin(request)
+    if denied:
+        return JSONResponse({"error": denied}, status_code=403)
+    return JSONResponse({
+        "pid": os.getpid(),
+        "threshold_ms": SLOW_CALL_MS,
+        "calls": list(reversed(_slow_calls)),
+    })
+
+
+@mcp.custom_route("/debug/profile", methods=["GET"])
+async def profile_snapshot(request):
+    """
+    snapshot של profiler דוגם - מחזיר קובץ .folded (collapsed stacks) שנפתח
+    ב-speedscope או ב-flamegraph.pl. פרמטרים: seconds (ברירת מחדל 10), interval_ms (ברירת מחדל 10).
+    """
+    from starlette.responses import JSONResponse, Response
+
+    denied = _check_admin(request)
+    if denied:
+        return JSONResponse({"error": denied}, status_code=403)
+    try:
+        seconds = min(float(request.query_params.get("seconds", 10)), PROFILE_MAX_SECONDS)
+        interval = max(float(request.query_params.get("interval_ms", 10)), 1) / 1000
+    except ValueError:
+        return JSONResponse({"error": "seconds ו-interval_ms חייבים להיות מספרים"}, status_code=400)
+    if not _sampler_lock.acquire(blocking=False):
+        return JSONResponse({"error": "דגימה אחרת כבר רצה ב-worker הזה"}, status_code=409)
+    try:
+        samples, stacks = await asyncio.to_thread(_sample_stacks, seconds, interval)
+    finally:
+        _sampler_lock.release()
+
+    body = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    filename = f"profile-{os.getpid()}-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.folded"
+    return Response(body, media_type="text/plain", headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Profile-Samples": str(samples),
+    })
+
+
 # ── Entrypoint ──────────────────────────────────────────────
 
+def _boot_elapsed_ms() -> float:
+    return round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+
+
+# כל הכלים, ה-prompts והנתיבים נרשמו - סוף אתחול המודול
+_startup["init_ms"] = _boot_elapsed_ms()
+_startup["skipped_tools"] = _skipped_tools
+
+
+def create_app():
+    """
+    app factory - נקרא פעם אחת בכל worker. כל worker פותח Mongo ו-HTTP pools
+    משלו, וסוגר אותם רק אחרי שבקשות פתוחות הסתיימו (uvicorn מנקז ב-SIGTERM).
+    """
+    if WORKERS > 1:
+        claim_index_slot(WORKERS)
+    app = mcp.streamable_http_app()
+    session_lifespan = app.router.lifespan_context
+    _startup["app_ms"] = _boot_elapsed_ms()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # uvicorn מתחיל להאזין מיד אחרי ש-startup של ה-lifespan מסתיים
+        _startup["listening_ms"] = _boot_elapsed_ms()
+        warm_task = asyncio.create_task(warm_up()) if WARMUP_ON_START else None
+        probe_task = asyncio.create_task(run_health_prober())
+        async with session_lifespan(app):
+            yield
+        probe_task.cancel()
+        if warm_task and not warm_task.done():
+            warm_task.cancel()
+        await close_http_client()
+        await asyncio.to_thread(_semantic_index.flush)
+        if _mongo_client is not None:
+            _mongo_client.close()
+        logger.info(f"worker {os.getpid()} נסגר")
+
+    app.router.lifespan_context = lifespan
+    return app
+
+
 if __name__ == "__main__":
     import uvicorn
-    logger.info(f"מפעיל CodeBot MCP Server v2 על פורט {PORT}")
+    logger.info(f"מפעיל CodeBot MCP Server v2 על פורט {PORT} ({WORKERS} workers)")
     uvicorn.run(
-        mcp.streamable_http_app(),
+        # ריבוי workers מחייב import string, ו-uvicorn קורא ל-factory בכל תהליך
+        "server:create_app" if WORKERS > 1 else create_app(),
+        factory=WORKERS > 1,
         host="0.0.0.0",
         port=PORT,
+        workers=WORKERS,
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS,
     )